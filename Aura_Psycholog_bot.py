@@ -31,11 +31,19 @@ import re
 import json
 import time
 import uuid
+import heapq
 import hashlib
+import hmac
 import asyncio
+import multiprocessing
+import logging
+import itertools
+import tempfile
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, List, Tuple, AsyncGenerator
+from datetime import date, datetime, timedelta
+from typing import Optional, Dict, Any, List, Set, Tuple, AsyncGenerator, AsyncIterator, Awaitable, Callable
 from urllib.parse import urljoin
 
 # Попробуем прочитать .env, если установлен python-dotenv (не обязательно)
@@ -45,7 +53,9 @@ try:
 except Exception:
     pass
 
-from db import Base, SessionLocal, init_db
+from db import Base, SessionLocal, init_db, session_scope
+
+logger = logging.getLogger("aura")
 
 # -------------------------
 # 1) НАСТРОЙКИ
@@ -57,9 +67,99 @@ DEEPSEEK_MODEL     = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
 REDIS_URL          = os.getenv("REDIS_URL")  # если есть — используем для антиспама/временных состояний
 CONVERSATION_HISTORY_LIMIT = int(os.getenv("CONVERSATION_HISTORY_LIMIT", "10"))
 
+# Приём апдейтов: polling (по умолчанию) или webhook (ASGI-приложение webhook_app, можно запускать в несколько воркеров)
+BOT_MODE           = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_BASE_URL   = (os.getenv("WEBHOOK_BASE_URL") or "").rstrip("/")  # публичный https-адрес, например https://bot.example.com
+WEBHOOK_PATH       = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET     = os.getenv("WEBHOOK_SECRET", "")  # проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_HOST       = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT       = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_WORKERS    = int(os.getenv("WEBHOOK_WORKERS", "1"))
+# апдейты одного пользователя попадают в разные процессы: кэши в памяти процесса выключаются,
+# а антиспам, квоты и FSM обязаны жить в Redis
+MULTI_WORKER_WEBHOOK = BOT_MODE == "webhook" and WEBHOOK_WORKERS > 1
+# BOT_MODE=sharded: один процесс забирает апдейты и раздаёт их воркерам по from_user.id % SHARD_WORKERS
+SHARD_WORKERS      = int(os.getenv("SHARD_WORKERS", str(os.cpu_count() or 2)))
+SHARD_QUEUE_SIZE   = int(os.getenv("SHARD_QUEUE_SIZE", "1000"))  # пачек апдейтов в очереди одного воркера
+# апдейтов, принятых воркером и ещё не обработанных; дальше воркер не читает очередь и она держит напор
+SHARD_MAX_PENDING  = int(os.getenv("SHARD_MAX_PENDING", "1024"))
+# Фоновые задачи в единственном экземпляре (компактация истории, прогрев медиа): auto — их запускает процесс,
+# первым взявший файловую блокировку BACKGROUND_JOBS_LOCK (один на хост); on/off — принудительно
+BACKGROUND_JOBS    = os.getenv("BACKGROUND_JOBS", "auto").lower()
+BACKGROUND_JOBS_LOCK = os.getenv("BACKGROUND_JOBS_LOCK") or os.path.join(
+    tempfile.gettempdir(), f"aura-jobs-{TELEGRAM_BOT_TOKEN.split(':', 1)[0] or 'bot'}.lock"
+)
+
+# Пул соединений к LLM (один клиент на весь процесс)
+DEEPSEEK_MAX_CONNECTIONS      = int(os.getenv("DEEPSEEK_MAX_CONNECTIONS", "20"))
+DEEPSEEK_MAX_KEEPALIVE        = int(os.getenv("DEEPSEEK_MAX_KEEPALIVE", "10"))
+DEEPSEEK_KEEPALIVE_EXPIRY     = float(os.getenv("DEEPSEEK_KEEPALIVE_EXPIRY", "60"))
+DEEPSEEK_HTTP2                = os.getenv("DEEPSEEK_HTTP2", "0").lower() in {"1", "true", "yes"}
+DEEPSEEK_CONNECT_TIMEOUT      = float(os.getenv("DEEPSEEK_CONNECT_TIMEOUT", "5"))
+DEEPSEEK_READ_TIMEOUT         = float(os.getenv("DEEPSEEK_READ_TIMEOUT", "30"))
+
+# Потоковые ответы: бот правит одно сообщение по мере генерации (не чаще раза в интервал)
+LLM_STREAMING                 = os.getenv("LLM_STREAMING", "1").lower() in {"1", "true", "yes"}
+LLM_STREAM_EDIT_INTERVAL      = float(os.getenv("LLM_STREAM_EDIT_INTERVAL", "1.0"))
+
+# Допуск к LLM: сколько запросов одновременно, сколько ждут в очереди и как долго
+LLM_MAX_CONCURRENCY           = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_QUEUE_SIZE                = int(os.getenv("LLM_QUEUE_SIZE", "50"))
+LLM_QUEUE_DEADLINE            = float(os.getenv("LLM_QUEUE_DEADLINE", "20"))
+
+# Сообщения одного пользователя, пришедшие в пределах окна (мс), отвечаются одним запросом к LLM
+LLM_BURST_WINDOW_MS           = int(os.getenv("LLM_BURST_WINDOW_MS", "700"))
+
+# Бюджет промпта: свежие реплики дословно в пределах бюджета токенов, старые — в фоновом резюме
+LLM_HISTORY_TOKEN_BUDGET      = int(os.getenv("LLM_HISTORY_TOKEN_BUDGET", "1500"))
+LLM_SUMMARY_TOKEN_LIMIT       = int(os.getenv("LLM_SUMMARY_TOKEN_LIMIT", "400"))
+
+# Кэш истории диалогов в памяти процесса: сколько пользователей держать (LRU)
+HISTORY_CACHE_USERS           = int(os.getenv("HISTORY_CACHE_USERS", "10000"))
+
+# Кэш «tg_id → внутренний id, персона, тариф»: размер (LRU) и время жизни записи в секундах
+IDENTITY_CACHE_SIZE           = int(os.getenv("IDENTITY_CACHE_SIZE", "50000"))
+IDENTITY_CACHE_TTL            = float(os.getenv("IDENTITY_CACHE_TTL", "600"))
+
+# Фоновая компактация conversation_messages: как часто (сек) и сколько реплик пользователя читать за одну свёртку
+HISTORY_COMPACTION_INTERVAL   = float(os.getenv("HISTORY_COMPACTION_INTERVAL", "60"))
+HISTORY_COMPACTION_BATCH      = int(os.getenv("HISTORY_COMPACTION_BATCH", "500"))
+
+# Отложенная запись (write-behind) реплик после ответа: размер очереди, пачки и период сброса (мс)
+WRITE_BEHIND_QUEUE_SIZE       = int(os.getenv("WRITE_BEHIND_QUEUE_SIZE", "5000"))
+WRITE_BEHIND_BATCH            = int(os.getenv("WRITE_BEHIND_BATCH", "200"))
+WRITE_BEHIND_FLUSH_MS         = int(os.getenv("WRITE_BEHIND_FLUSH_MS", "200"))
+
+# Журнал событий: пакетная запись event_logs; при переполнении очереди — drop (терять события) или block (ждать)
+EVENT_LOG_QUEUE_SIZE          = int(os.getenv("EVENT_LOG_QUEUE_SIZE", "10000"))
+EVENT_LOG_BATCH               = int(os.getenv("EVENT_LOG_BATCH", "500"))
+EVENT_LOG_FLUSH_MS            = int(os.getenv("EVENT_LOG_FLUSH_MS", "1000"))
+EVENT_LOG_OVERFLOW            = os.getenv("EVENT_LOG_OVERFLOW", "drop").lower()
+
+# Суточная квота запросов к LLM для пользователей без тарифа (0 — без ограничения) и период сброса счётчиков в БД (сек)
+FREE_DAILY_REQUESTS           = int(os.getenv("FREE_DAILY_REQUESTS", "0"))
+QUOTA_FLUSH_INTERVAL          = float(os.getenv("QUOTA_FLUSH_INTERVAL", "30"))
+
+# Сколько апдейтов обрабатывается одновременно во всём процессе; апдейты одного пользователя — строго по очереди
+UPDATE_MAX_IN_FLIGHT          = int(os.getenv("UPDATE_MAX_IN_FLIGHT", "256"))
+
+# Хранилище FSM (дневник, шкалы): memory | sql | redis; по умолчанию redis при REDIS_URL, иначе memory.
+# sql — по желанию: aiogram читает состояние на каждом апдейте, это лишний SELECT к основной БД.
+# FSM_STATE_TTL — сколько секунд хранить незавершённое состояние
+FSM_STORAGE                   = (os.getenv("FSM_STORAGE") or ("redis" if os.getenv("REDIS_URL") else "memory")).lower()
+FSM_STATE_TTL                 = int(os.getenv("FSM_STATE_TTL", "86400"))
+
+# In-memory антиспам (без Redis): жёсткий лимит ключей в каждой из структур дедупа и лимита частоты
+ANTISPAM_MAX_KEYS             = int(os.getenv("ANTISPAM_MAX_KEYS", "100000"))
+
 # Новые настройки аудио/рефералок
 AUDIO_DIR          = os.getenv("AUDIO_DIR", os.path.join(os.path.dirname(__file__), "meditations"))
 AUDIO_BASE_URL     = (os.getenv("AUDIO_BASE_URL") or "").rstrip("/") or None
+# JSON-манифест медитаций на CDN (по умолчанию <AUDIO_BASE_URL>/index.json) и период пересканирования каталога, сек
+AUDIO_MANIFEST_URL = os.getenv("AUDIO_MANIFEST_URL") or None
+MEDITATION_RESCAN_INTERVAL = float(os.getenv("MEDITATION_RESCAN_INTERVAL", "30"))
+# Служебный чат (id), куда бот заранее загружает аудио каталога, чтобы пользователям уходил готовый file_id
+MEDIA_PREWARM_CHAT_ID = int(os.getenv("MEDIA_PREWARM_CHAT_ID", "0")) or None
 
 REF_SALT                 = int(os.getenv("REF_SALT", "8349271"))
 REF_BONUS_DAYS_JOINED    = int(os.getenv("REF_BONUS_DAYS_JOINED", "7"))
@@ -111,14 +211,8 @@ CRISIS_TEXT = (
     "Если хотите, составим план безопасности на ближайший час: 1) где вы, 2) кто рядом, 3) что снизит остроту на 10%?"
 )
 
-def text_matches(*variants: str):
-    """Упрощённая проверка текста сообщения с учётом регистра и пробелов."""
-    normalized = {variant.casefold() for variant in variants}
-
-    def _checker(text: Optional[str]) -> bool:
-        return bool(text) and text.strip().casefold() in normalized
-
-    return F.text.func(_checker)
+# users.plan по умолчанию — бесплатный доступ без тарифа
+FREE_PLAN = "LIGHT"
 
 TARIFF_PLAN_ORDER = [
     "znakomstvo",
@@ -135,6 +229,7 @@ TARIFF_PLANS: Dict[str, Dict[str, Any]] = {
         "limits": "до 30 запросов в сутки, 1 активный чат, 1 администратор",
         "support": "базовая, ответ в течение 24 часов",
         "trial": "7 дней, доступно до 10 запросов",
+        "daily_requests": 30,
         "extra_events_price": 900,
         "addons": [
             "расширенный трекер привычек — 500 ₽/мес",
@@ -149,6 +244,7 @@ TARIFF_PLANS: Dict[str, Dict[str, Any]] = {
         "limits": "до 80 запросов в сутки, 3 активных чата, 2 администратора",
         "support": "приоритетная, ответ в течение 12 часов",
         "trial": "10 дней, доступно до 25 запросов",
+        "daily_requests": 80,
         "extra_events_price": 750,
         "addons": [
             "групповая терапия онлайн — 1 200 ₽/мес",
@@ -163,6 +259,7 @@ TARIFF_PLANS: Dict[str, Dict[str, Any]] = {
         "limits": "до 200 запросов в сутки, 6 активных чатов, 4 администратора",
         "support": "премиум, ответ в течение 4 часов, личный куратор",
         "trial": "14 дней, доступно до 50 запросов",
+        "daily_requests": 200,
         "extra_events_price": 600,
         "addons": [
             "индивидуальные консультации — 2 500 ₽ за сессию",
@@ -206,18 +303,19 @@ TARIFF_FAQ: List[Dict[str, str]] = [
 #    Храним: пользователей, дневник, результаты тестов, события, кэш медиа, рефералы, бонусы.
 # -------------------------
 from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy import String, Integer, DateTime, ForeignKey, Text, JSON, Boolean, select, delete, text as sqltext, func
+from sqlalchemy import String, Integer, BigInteger, Float, Date, DateTime, UniqueConstraint, ForeignKey, Text, JSON, Boolean, select, insert, delete, func, event
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.asyncio import AsyncSession
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import BackgroundTasks, FastAPI, Depends, HTTPException, Request, status
 from pydantic import BaseModel, EmailStr, Field
 
 class User(Base):
     __tablename__ = "users"
     id: Mapped[int]       = mapped_column(Integer, primary_key=True)
-    tg_id: Mapped[str]    = mapped_column(String, unique=True, index=True)
+    tg_id: Mapped[int]    = mapped_column(BigInteger, unique=True, index=True)
     username: Mapped[Optional[str]] = mapped_column(String, nullable=True)
     persona: Mapped[str]  = mapped_column(String, default="pro_psychologist")
-    plan: Mapped[str]     = mapped_column(String, default="LIGHT")
+    plan: Mapped[str]     = mapped_column(String, default=FREE_PLAN)
     created_at: Mapped[Any] = mapped_column(DateTime(timezone=True), server_default=func.now())
 
 class JournalEntry(Base):
@@ -236,6 +334,31 @@ class ConversationMessage(Base):
     content: Mapped[str]  = mapped_column(Text, nullable=False)
     created_at: Mapped[Any] = mapped_column(DateTime(timezone=True), server_default=func.now())
 
+class ConversationSummary(Base):
+    __tablename__ = "conversation_summaries"
+    id: Mapped[int]       = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[int]  = mapped_column(Integer, ForeignKey("users.id"), unique=True, index=True)
+    summary: Mapped[str]  = mapped_column(Text, nullable=False, default="")
+    turns_folded: Mapped[int] = mapped_column(Integer, default=0)  # сколько реплик уже свёрнуто в резюме
+    # реплики пользователя с id <= этого уже в резюме и удалены из conversation_messages
+    folded_until_id: Mapped[int] = mapped_column(Integer, default=0)
+    updated_at: Mapped[Any] = mapped_column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class UsageCounter(Base):
+    __tablename__ = "usage_counters"
+    __table_args__ = (UniqueConstraint("user_id", "day"),)
+    id: Mapped[int]       = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[int]  = mapped_column(Integer, ForeignKey("users.id"), index=True)
+    day: Mapped[date]     = mapped_column(Date, index=True)
+    requests: Mapped[int] = mapped_column(Integer, default=0)  # запросов к LLM за сутки
+
+class FsmRecord(Base):
+    __tablename__ = "fsm_states"
+    key: Mapped[str]      = mapped_column(String, primary_key=True)  # ключ FSM aiogram (бот, чат, пользователь)
+    state: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    data: Mapped[dict]    = mapped_column(JSON, default=dict)
+    expires_at: Mapped[float] = mapped_column(Float, index=True)  # unix-время, после которого запись не действует
+
 class ScaleResult(Base):
     __tablename__ = "scale_results"
     id: Mapped[int]       = mapped_column(Integer, primary_key=True)
@@ -248,7 +371,7 @@ class ScaleResult(Base):
 class EventLog(Base):
     __tablename__ = "event_logs"
     id: Mapped[int]       = mapped_column(Integer, primary_key=True)
-    user_tg_id: Mapped[str] = mapped_column(String, index=True)
+    user_tg_id: Mapped[int] = mapped_column(BigInteger, index=True)
     event: Mapped[str]    = mapped_column(String)  # message_sent, ai_reply, crisis_detected ...
     payload: Mapped[Optional[dict]] = mapped_column(JSON, nullable=True)
     created_at: Mapped[Any] = mapped_column(DateTime(timezone=True), server_default=func.now())
@@ -257,7 +380,7 @@ class EventLog(Base):
 class MediaCache(Base):
     __tablename__ = "media_cache"
     id: Mapped[int]       = mapped_column(Integer, primary_key=True)
-    key: Mapped[str]      = mapped_column(String, unique=True, index=True)  # например, med:<slug>
+    key: Mapped[str]      = mapped_column(String, unique=True, index=True)  # например, med:<хэш содержимого>
     file_id: Mapped[str]  = mapped_column(String)  # Telegram file_id
     created_at: Mapped[Any] = mapped_column(DateTime(timezone=True), server_default=func.now())
 
@@ -265,15 +388,15 @@ class Referral(Base):
     __tablename__ = "referrals"
     id: Mapped[int]            = mapped_column(Integer, primary_key=True)
     code: Mapped[str]          = mapped_column(String, index=True)              # реф.код, с которым пришёл пользователь
-    referrer_tg_id: Mapped[str]= mapped_column(String, index=True)              # кто пригласил
-    referred_tg_id: Mapped[Optional[str]] = mapped_column(String, index=True, nullable=True)  # кто пришёл
+    referrer_tg_id: Mapped[int]= mapped_column(BigInteger, index=True)          # кто пригласил
+    referred_tg_id: Mapped[Optional[int]] = mapped_column(BigInteger, index=True, nullable=True)  # кто пришёл
     status: Mapped[str]        = mapped_column(String)  # clicked | joined | paid | self | invalid
     created_at: Mapped[Any]    = mapped_column(DateTime(timezone=True), server_default=func.now())
 
 class UserBonus(Base):
     __tablename__ = "user_bonuses"
     id: Mapped[int]            = mapped_column(Integer, primary_key=True)
-    user_tg_id: Mapped[str]    = mapped_column(String, index=True)
+    user_tg_id: Mapped[int]    = mapped_column(BigInteger, index=True)
     type: Mapped[str]          = mapped_column(String)  # ref_join, ref_paid, promo и т.п.
     days: Mapped[int]          = mapped_column(Integer, default=0)
     activated: Mapped[bool]    = mapped_column(Boolean, default=True)
@@ -281,6 +404,15 @@ class UserBonus(Base):
     created_at: Mapped[Any]    = mapped_column(DateTime(timezone=True), server_default=func.now())
     activated_at: Mapped[Optional[Any]] = mapped_column(DateTime(timezone=True), nullable=True)
 
+class ReferralCounter(Base):
+    __tablename__ = "referral_counters"
+    user_tg_id: Mapped[int]    = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    clicked: Mapped[int]       = mapped_column(Integer, default=0)  # приглашённые по статусу referrals.status
+    joined: Mapped[int]        = mapped_column(Integer, default=0)
+    paid: Mapped[int]          = mapped_column(Integer, default=0)
+    bonus_days: Mapped[int]    = mapped_column(Integer, default=0)  # сумма days активированных user_bonuses
+    updated_at: Mapped[Any]    = mapped_column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
 
 # Дополнительные таблицы и логика для SaaS-рефералок (интеграция referral_app)
 class ReferralPortalUser(Base):
@@ -718,25 +850,160 @@ async def api_my_referrals(
     )
 
 
-async def init_db():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+# -------------------------
+# 3.1 Отложенная запись в БД (write-behind): вставки копятся в очереди и пишутся пачками
+# -------------------------
+class BackgroundWriter:
+    """Принимает строки для вставки без ожидания commit; фоновая задача пишет их пачками в одной транзакции."""
+
+    def __init__(self, name: str, max_queue: int, batch_size: int, flush_interval_ms: int,
+                 overflow: str = "block") -> None:
+        if overflow not in {"block", "drop"}:
+            raise ValueError(f"Неизвестная политика переполнения очереди: {overflow}")
+        self.name = name
+        self.overflow = overflow
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0, flush_interval_ms) / 1000
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, max_queue))
+        self._task: Optional[asyncio.Task] = None
+        self.enqueued = 0
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+        self.batches = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def put(self, model: Any, row: Dict[str, Any]) -> None:
+        self.enqueued += 1
+        if not self.running:
+            # фоновая задача не запущена (например, вне бота) — пишем сразу
+            await self._write([(model, row, time.monotonic())])
+            return
+        if self.overflow == "drop":
+            try:
+                self._queue.put_nowait((model, row, time.monotonic()))
+            except asyncio.QueueFull:
+                self.enqueued -= 1
+                self.dropped += 1
+            return
+        await self._queue.put((model, row, time.monotonic()))  # при переполнении ждём: очередь ограничена
+
+    def start(self) -> None:
+        if not self.running:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        """Дописывает всё, что осталось в очереди, и останавливает фоновую задачу."""
+        if not self.running:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            closing = False
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get_nowait() if timeout <= 0 else await asyncio.wait_for(self._queue.get(), timeout)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+            await self._write(batch)
+            if closing:
+                return
+
+    async def _write(self, batch: List[Tuple[Any, Dict[str, Any], float]]) -> None:
+        rows_by_model: Dict[Any, List[Dict[str, Any]]] = {}
+        for model, row, _ in batch:
+            rows_by_model.setdefault(model, []).append(row)
+        try:
+            async with SessionLocal() as s:
+                for model, rows in rows_by_model.items():
+                    await s.execute(insert(model), rows)
+                await s.commit()
+        except Exception:
+            self.failed += len(batch)
+            logger.exception("Фоновая запись %s: не удалось сохранить %s строк", self.name, len(batch))
+            return
+        self.written += len(batch)
+        self.batches += 1
+        self.last_lag = time.monotonic() - batch[0][2]  # сколько ждала самая старая строка пачки
+        self.max_lag = max(self.max_lag, self.last_lag)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": self.enqueued - self.written - self.failed,  # ещё не сохранено в БД
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "last_lag_ms": round(self.last_lag * 1000, 1),
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+        }
+
+conversation_writer = BackgroundWriter("conversation", WRITE_BEHIND_QUEUE_SIZE, WRITE_BEHIND_BATCH, WRITE_BEHIND_FLUSH_MS)
+event_writer = BackgroundWriter("event_logs", EVENT_LOG_QUEUE_SIZE, EVENT_LOG_BATCH, EVENT_LOG_FLUSH_MS,
+                                overflow=EVENT_LOG_OVERFLOW)
 
 # -------------------------
 # 4) ПРОСТОЙ ЛОГ СОБЫТИЙ (с очисткой телефонов/e-mail)
 # -------------------------
+class PIIRedactor:
+    """Маскирует e-mail и телефоны в строковых листьях payload, сохраняя ключи, вложенность и типы."""
+
+    PATTERN = re.compile(
+        r"(?P<email>[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,})"
+        r"|(?P<phone>\+?\d[\d\s\-()]{8,}\d)"
+    )
+    REPLACEMENTS = {"email": "[email]", "phone": "[phone]"}
+    # служебные поля, в которых персональных данных не бывает
+    SAFE_KEYS = frozenset({
+        "len", "score", "slug", "scale", "source", "type", "days", "activated", "plan",
+        "period", "price", "persona", "mood", "reason", "code",
+    })
+
+    def __init__(self, safe_keys: Optional[frozenset] = None) -> None:
+        self.safe_keys = self.SAFE_KEYS if safe_keys is None else safe_keys
+
+    def _replace(self, match: "re.Match[str]") -> str:
+        return self.REPLACEMENTS[match.lastgroup]
+
+    def redact(self, value: Any) -> Any:
+        if isinstance(value, str):
+            return self.PATTERN.sub(self._replace, value)
+        if isinstance(value, dict):
+            safe = self.safe_keys
+            return {k: (v if k in safe else self.redact(v)) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self.redact(v) for v in value]
+        return value  # числа, bool, None
+
+pii_redactor = PIIRedactor()
+
 def _redact_pii(obj: Optional[dict]) -> Optional[dict]:
     if not obj:
         return obj
-    text = json.dumps(obj, ensure_ascii=False)
-    text = re.sub(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}", "[email]", text)
-    text = re.sub(r"(\+?\d[\d\s\-()]{8,}\d)", "[phone]", text)
-    return {"text": text}
+    return pii_redactor.redact(obj)
 
-async def log_event(user_tg_id: str, event: str, payload: Optional[dict] = None):
-    async with SessionLocal() as s:
-        s.add(EventLog(user_tg_id=user_tg_id, event=event, payload=_redact_pii(payload)))
-        await s.commit()
+async def log_event(user_tg_id: int, event: str, payload: Optional[dict] = None):
+    # событие только ставится в очередь: в БД его пачкой запишет event_writer
+    await event_writer.put(EventLog, {"user_tg_id": user_tg_id, "event": event, "payload": _redact_pii(payload)})
 
 # -------------------------
 # 5) АНТИСПАМ И ДЕДУП (Redis ИЛИ in-memory)
@@ -749,104 +1016,1141 @@ if REDIS_URL:
     except Exception:
         _redis = None
 
-_recent_hashes: Dict[str, float] = {}  # in-memory TTL по ключу user:text
+class ExpiringLRU:
+    """Словарь с TTL и жёстким лимитом ключей для in-memory антиспама.
+
+    Записи лежат в порядке последней записи; при каждой вставке с головы снимаются
+    просроченные, а при переполнении — самые старые, поэтому каждая запись
+    вытесняется ровно один раз (амортизированно O(1)) и память не растёт.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max(1, max_size)
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self.expired = 0
+        self.evicted = 0
+        self._started = time.monotonic()
+
+    def get(self, key: str) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            self.expired += 1
+            return None
+        return entry[1]
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        now = time.monotonic()
+        self._entries[key] = (now + ttl, value)
+        self._entries.move_to_end(key)
+        self._prune(now)
+
+    def _prune(self, now: float) -> None:
+        entries = self._entries
+        while entries:
+            key, (expires_at, _) = next(iter(entries.items()))
+            if expires_at > now:
+                break
+            del entries[key]
+            self.expired += 1
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+            self.evicted += 1
+
+    def stats(self) -> Dict[str, Any]:
+        uptime = max(time.monotonic() - self._started, 1e-9)
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "evictions_per_sec": round((self.expired + self.evicted) / uptime, 3),
+        }
+
+_recent_hashes = ExpiringLRU(ANTISPAM_MAX_KEYS)  # in-memory TTL по ключу user:text
+_user_minute_counts = ExpiringLRU(ANTISPAM_MAX_KEYS)  # user → (минута, счётчик)
+
+def _text_digest(text: str) -> str:
+    # стабильный между перезапусками и воркерами, в отличие от солёного hash()
+    return hashlib.blake2b(text.strip().encode("utf-8"), digest_size=8).hexdigest()
+
+# Один вызов на сообщение: скользящее окно частоты (ZSET с отметками времени) + дедуп через SET NX EX.
+# KEYS[1] — окно пользователя, KEYS[2] — ключ дедупа (необязателен).
+# ARGV: сейчас (мс), ширина окна (мс), лимит, уникальный member, TTL дедупа (сек).
+# Ответ: 0 — пропустить, 1 — превышен лимит, 2 — повтор.
+ANTISPAM_LUA = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+    return 1
+end
+redis.call('ZADD', KEYS[1], now, ARGV[4])
+redis.call('PEXPIRE', KEYS[1], window)
+if KEYS[2] and not redis.call('SET', KEYS[2], '1', 'NX', 'EX', ARGV[5]) then
+    return 2
+end
+return 0
+"""
+_antispam_script = _redis.register_script(ANTISPAM_LUA) if _redis else None
+
+ANTISPAM_RATE_LIMITED = "rate_limited"
+ANTISPAM_DUPLICATE = "duplicate"
+
+async def _redis_antispam(user_id: int, text: Optional[str], max_per_minute: int, ttl_sec: int) -> Optional[str]:
+    keys = [f"rate:{user_id}"]
+    if text:
+        keys.append(f"anti:{user_id}:{_text_digest(text)}")
+    verdict = await _antispam_script(
+        keys=keys,
+        args=[int(time.time() * 1000), 60_000, max_per_minute, uuid.uuid4().hex, ttl_sec],
+    )
+    return {1: ANTISPAM_RATE_LIMITED, 2: ANTISPAM_DUPLICATE}.get(int(verdict))
 
 async def is_duplicate(user_id: int, text: str, ttl_sec: int = 30) -> bool:
     if not text:
         return False
-    key = f"{user_id}:{hash(text.strip())}"
-    now = time.time()
+    key = f"{user_id}:{_text_digest(text)}"
     if _redis:
-        exists = await _redis.exists(f"anti:{key}")
-        if exists:
-            return True
-        await _redis.setex(f"anti:{key}", ttl_sec, "1")
-        return False
+        # SET NX атомарен: из двух одновременных копий пройдёт ровно одна
+        return not await _redis.set(f"anti:{key}", "1", nx=True, ex=ttl_sec)
     # in-memory
-    if key in _recent_hashes and now - _recent_hashes[key] < ttl_sec:
+    if _recent_hashes.get(key) is not None:
         return True
-    _recent_hashes[key] = now
+    _recent_hashes.set(key, True, ttl_sec)
     return False
 
-_user_minute_counts: Dict[str, int] = {}
-_user_minute_ts: Dict[str, int] = {}
-
 async def rate_limited(user_id: int, max_per_minute: int = 20) -> bool:
-    now_min = int(time.time() // 60)
+    if _redis:
+        return await _redis_antispam(user_id, None, max_per_minute, 0) == ANTISPAM_RATE_LIMITED
+    # in-memory: счётчик живёт до конца текущей минуты
+    now = time.time()
+    now_min = int(now // 60)
     uid = str(user_id)
+    bucket = _user_minute_counts.get(uid)
+    count = bucket[1] + 1 if bucket and bucket[0] == now_min else 1
+    _user_minute_counts.set(uid, (now_min, count), (now_min + 1) * 60 - now)
+    return count > max_per_minute
+
+async def antispam_check(user_id: int, text: Optional[str], max_per_minute: int = 20,
+                         ttl_sec: int = 30) -> Optional[str]:
+    """Лимит частоты и дедуп одним шагом: с Redis — один round trip, иначе — структуры в памяти."""
     if _redis:
-        # простой вариант в Redis
-        key = f"rate:{uid}:{now_min}"
-        cnt = await _redis.incr(key)
-        await _redis.expire(key, 60)
-        return cnt > max_per_minute
-    # in-memory
-    last = _user_minute_ts.get(uid)
-    if last != now_min:
-        _user_minute_ts[uid] = now_min
-        _user_minute_counts[uid] = 0
-    _user_minute_counts[uid] = _user_minute_counts.get(uid, 0) + 1
-    return _user_minute_counts[uid] > max_per_minute
+        return await _redis_antispam(user_id, text, max_per_minute, ttl_sec)
+    if await rate_limited(user_id, max_per_minute):
+        return ANTISPAM_RATE_LIMITED
+    if await is_duplicate(user_id, text, ttl_sec):
+        return ANTISPAM_DUPLICATE
+    return None
+
+def antispam_stats() -> Dict[str, Any]:
+    return {"duplicates": _recent_hashes.stats(), "rate": _user_minute_counts.stats()}
 
 # -------------------------
 # 6) ОБНАРУЖЕНИЕ ОПАСНЫХ ФРАЗ (кризис)
 # -------------------------
-def detect_risk(text: str) -> Optional[str]:
-    if not text:
-        return None
-    patterns_suicide = [
+class CrisisDetector:
+    """Поиск кризисных фраз одним заранее скомпилированным выражением по нормализованному тексту.
+
+    Все шаблоны склеиваются в одну альтернацию с именованными группами по меткам,
+    поэтому сообщение просматривается один раз независимо от числа шаблонов.
+    Метки перечисляются в порядке приоритета: при нескольких совпадениях
+    возвращается самая важная.
+    """
+
+    # латинские буквы, похожие на кириллические (после lower())
+    LOOKALIKES = str.maketrans("aceopxykmthbu", "асеорхукмтнви")
+    INVISIBLE = dict.fromkeys(map(ord, "\u00ad\u200b\u200c\u200d\u2060\ufeff"))
+    SPACES = re.compile(r"\s+")
+    # «(» без «?» — захватывающая группа; в общей альтернации они многократно замедляют поиск
+    CAPTURING = re.compile(r"(?<!\\)\((?!\?)")
+
+    def __init__(self, patterns: Dict[str, List[str]]) -> None:
+        self.labels = list(patterns)
+        groups = []
+        for label, items in patterns.items():
+            body = "|".join(f"(?:{self.CAPTURING.sub('(?:', p)})" for p in items)
+            groups.append(f"(?P<{label}>{body})")
+        self.pattern = re.compile("|".join(groups))
+
+    @classmethod
+    def normalize(cls, text: str) -> str:
+        text = text.lower().replace("ё", "е").translate(cls.INVISIBLE).translate(cls.LOOKALIKES)
+        return cls.SPACES.sub(" ", text)
+
+    def detect(self, text: str) -> Optional[str]:
+        if not text:
+            return None
+        found = {m.lastgroup for m in self.pattern.finditer(self.normalize(text))}
+        if not found:
+            return None
+        return next(label for label in self.labels if label in found)
+
+# Шаблоны пишутся в нормализованной форме: строчные буквы, «е» вместо «ё».
+CRISIS_PATTERNS: Dict[str, List[str]] = {
+    "suicide": [
         r"\b(хочу|думаю|планирую)\s+(умереть|сдохнуть|покончить\s+с\s+собой)\b",
-        r"\b(не\s+хочу\s+жить|жить\s+не\s+хочу)\b",
-        r"\b(суицид|самоубийств[оа])\b",
+        r"\b(не\s+хочу\s+(больше\s+)?жить|жить\s+(больше\s+)?не\s+хочу)\b",
+        r"\b(суицид\w*|самоубийств\w*)",
         r"\b(порезать\s*ся|повесить\s*ся|перерезать\s*вены)\b",
         r"\b(навредить|вредить)\s+себе\b",
-    ]
-    patterns_violence = [r"\b(убить|навредить)\s+(его|ее|их|человеку|людям)\b"]
-    for p in patterns_suicide:
-        if re.search(p, text, re.IGNORECASE | re.UNICODE):
-            return "suicide"
-    for p in patterns_violence:
-        if re.search(p, text, re.IGNORECASE | re.UNICODE):
-            return "violence"
-    return None
+        r"\bпокончить\s+с\s+(собой|жизнью)\b",
+        r"\bубить\s+себя\b",
+    ],
+    "violence": [
+        r"\b(убить|навредить)\s+(его|ее|их|человеку|людям)\b",
+    ],
+}
+
+crisis_detector = CrisisDetector(CRISIS_PATTERNS)
+
+def detect_risk(text: str) -> Optional[str]:
+    return crisis_detector.detect(text)
 
 # -------------------------
 # 7) «МОЗГ» ДЛЯ ОТВЕТОВ (DeepSeek через HTTP)
 # -------------------------
 import httpx
 
+class LLMClient:
+    """Долгоживущий HTTP-клиент к DeepSeek: пул keep-alive соединений и счётчики переиспользования."""
+
+    def __init__(self) -> None:
+        self._client: Optional[httpx.AsyncClient] = None
+        self.requests_total = 0
+        self.connections_opened = 0
+        self.errors_total = 0
+
+    @property
+    def started(self) -> bool:
+        return self._client is not None and not self._client.is_closed
+
+    def start(self) -> None:
+        if self.started:
+            return
+        http2 = DEEPSEEK_HTTP2
+        if http2:
+            try:
+                import h2  # type: ignore  # noqa: F401
+            except ImportError:
+                logger.warning("DEEPSEEK_HTTP2=1, но пакет h2 не установлен — работаем по HTTP/1.1")
+                http2 = False
+        self._client = httpx.AsyncClient(
+            base_url=DEEPSEEK_BASE_URL,
+            headers={"Authorization": f"Bearer {DEEPSEEK_API_KEY}", "Content-Type": "application/json"},
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=DEEPSEEK_MAX_CONNECTIONS,
+                max_keepalive_connections=DEEPSEEK_MAX_KEEPALIVE,
+                keepalive_expiry=DEEPSEEK_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(
+                DEEPSEEK_READ_TIMEOUT,
+                connect=DEEPSEEK_CONNECT_TIMEOUT,
+                pool=DEEPSEEK_CONNECT_TIMEOUT,
+            ),
+        )
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _trace(self, event_name: str, info: Dict[str, Any]) -> None:
+        # httpcore сообщает о каждом новом TCP-соединении; всё остальное — переиспользование
+        if event_name == "connection.connect_tcp.complete":
+            self.connections_opened += 1
+
+    async def post_json(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        if not self.started:
+            self.start()
+        self.requests_total += 1
+        try:
+            resp = await self._client.post(path, json=payload, extensions={"trace": self._trace})
+            resp.raise_for_status()
+            return resp.json()
+        except Exception:
+            self.errors_total += 1
+            raise
+
+    async def stream_json(self, path: str, payload: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        """Читает SSE-ответ (`stream: true`) и отдаёт распарсенные события `data: {...}`."""
+        if not self.started:
+            self.start()
+        self.requests_total += 1
+        try:
+            async with self._client.stream("POST", path, json=payload, extensions={"trace": self._trace}) as resp:
+                resp.raise_for_status()
+                async for line in resp.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    if data:
+                        yield json.loads(data)
+        except Exception:
+            self.errors_total += 1
+            raise
+
+    def stats(self) -> Dict[str, Any]:
+        reused = max(0, self.requests_total - self.connections_opened)
+        return {
+            "requests": self.requests_total,
+            "connections_opened": self.connections_opened,
+            "connections_reused": reused,
+            "reuse_ratio": round(reused / self.requests_total, 3) if self.requests_total else 0.0,
+            "errors": self.errors_total,
+        }
+
+llm_client = LLMClient()
+
+LLM_NO_KEY_REPLY = "Я здесь, чтобы поддержать. Расскажите, что сейчас больше всего хочется прояснить? (подключите DEEPSEEK_API_KEY для умного ответа)"
+LLM_FALLBACK_REPLY = "Сейчас мне трудно ответить из-за перегрузки. Давайте попробуем ещё раз через минутку. Я рядом."
+
 async def deepseek_reply(messages: List[Dict[str, str]], temperature: float = 0.6, max_tokens: int = 600) -> str:
     # Если нет ключа — вернём мягкий заглушечный ответ (бот не сломается)
     if not DEEPSEEK_API_KEY:
-        return "Я здесь, чтобы поддержать. Расскажите, что сейчас больше всего хочется прояснить? (подключите DEEPSEEK_API_KEY для умного ответа)"
+        return LLM_NO_KEY_REPLY
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            resp = await client.post(
-                f"{DEEPSEEK_BASE_URL}/chat/completions",
-                headers={"Authorization": f"Bearer {DEEPSEEK_API_KEY}", "Content-Type": "application/json"},
-                json={"model": DEEPSEEK_MODEL, "messages": messages, "temperature": temperature, "max_tokens": max_tokens},
-            )
-            resp.raise_for_status()
-            data = resp.json()
-            return data["choices"][0]["message"]["content"]
+        data = await llm_client.post_json(
+            "/chat/completions",
+            {"model": DEEPSEEK_MODEL, "messages": messages, "temperature": temperature, "max_tokens": max_tokens},
+        )
+        return data["choices"][0]["message"]["content"]
+    except Exception:
+        return LLM_FALLBACK_REPLY
+
+async def deepseek_stream(messages: List[Dict[str, str]], temperature: float = 0.6, max_tokens: int = 600) -> AsyncIterator[str]:
+    """Потоковый вариант deepseek_reply: отдаёт куски текста по мере генерации."""
+    if not DEEPSEEK_API_KEY:
+        yield LLM_NO_KEY_REPLY
+        return
+    got_text = False
+    try:
+        async for event in llm_client.stream_json(
+            "/chat/completions",
+            {"model": DEEPSEEK_MODEL, "messages": messages, "temperature": temperature,
+             "max_tokens": max_tokens, "stream": True},
+        ):
+            choices = event.get("choices") or [{}]
+            delta = (choices[0].get("delta") or {}).get("content")
+            if delta:
+                got_text = True
+                yield delta
     except Exception:
-        return "Сейчас мне трудно ответить из-за перегрузки. Давайте попробуем ещё раз через минутку. Я рядом."
+        # если часть ответа уже показана — оставляем её, иначе отдаём обычную заглушку
+        if not got_text:
+            yield LLM_FALLBACK_REPLY
+
+# -------------------------
+# 7.1 Планировщик LLM: ограничение параллелизма, приоритетная очередь, отказ при переполнении
+# -------------------------
+class LLMQueueFull(Exception):
+    """Очередь к LLM заполнена — запрос отклоняется сразу."""
+
+class LLMDeadlineExceeded(Exception):
+    """Запрос не дождался своей очереди к LLM."""
+
+# чем старше тариф, тем меньше число и тем раньше запрос попадает к LLM; бесплатный план — после всех тарифов
+PLAN_PRIORITY: Dict[str, int] = {
+    **{code: rank for rank, code in enumerate(reversed(TARIFF_PLAN_ORDER))},
+    FREE_PLAN: len(TARIFF_PLAN_ORDER),
+}
+# фоновые задачи (резюме разговоров) — после любых пользовательских запросов
+BACKGROUND_PRIORITY = len(TARIFF_PLAN_ORDER) + 1
+
+def plan_priority(plan: Optional[str]) -> int:
+    # неизвестное значение users.plan обслуживается как бесплатный план
+    return PLAN_PRIORITY.get(plan or "", PLAN_PRIORITY[FREE_PLAN])
+
+class LLMScheduler:
+    """Пускает к LLM не больше max_concurrency запросов, остальных держит в ограниченной очереди по приоритету."""
+
+    def __init__(self, max_concurrency: int, max_queue: int) -> None:
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self._heap: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._waiting = 0
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._waiting
+
+    async def _acquire(self, priority: int, deadline: float) -> None:
+        if self.in_flight < self.max_concurrency and not self._waiting:
+            self.in_flight += 1
+            return
+        if self._waiting >= self.max_queue:
+            self.rejected += 1
+            raise LLMQueueFull()
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), fut))
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(fut, timeout=deadline)
+        except BaseException as exc:
+            if fut.done() and not fut.cancelled():
+                self._release()  # слот выдан одновременно с таймаутом/отменой — отдадим следующему
+            else:
+                self._waiting -= 1  # ушли из очереди, не получив слот
+            if isinstance(exc, asyncio.TimeoutError):
+                self.timed_out += 1
+                raise LLMDeadlineExceeded() from None
+            raise
+
+    def _release(self) -> None:
+        self.in_flight -= 1
+        while self._heap:
+            _, _, fut = heapq.heappop(self._heap)
+            if fut.done():
+                continue  # ожидающий уже ушёл по таймауту или отмене
+            self._waiting -= 1
+            self.in_flight += 1
+            fut.set_result(None)
+            break
+
+    @asynccontextmanager
+    async def slot(self, priority: int, deadline: float = LLM_QUEUE_DEADLINE) -> AsyncIterator[None]:
+        started = time.monotonic()
+        await self._acquire(priority, deadline)
+        waited = time.monotonic() - started
+        self.admitted += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_avg_ms": round(self.wait_total / self.admitted * 1000, 1) if self.admitted else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 1),
+        }
+
+llm_scheduler = LLMScheduler(LLM_MAX_CONCURRENCY, LLM_QUEUE_SIZE)
+
+LLM_BUSY_REPLY = "Сейчас ко мне очень много обращений 🙏 Напишите, пожалуйста, ещё раз через минуту — я отвечу."
+
+# -------------------------
+# 7.2 Сборка промпта по бюджету токенов и фоновое резюме разговора
+# -------------------------
+def estimate_tokens(text: str) -> int:
+    # грубая оценка без токенизатора: ~3 символа на токен для русского текста + служебные токены реплики
+    return len(text) // 3 + 4
+
+def build_prompt(system_prompt: str, summary: Optional[str], history: List[Any], user_text: str,
+                 budget: int = LLM_HISTORY_TOKEN_BUDGET) -> List[Dict[str, str]]:
+    """Системный промпт + резюме + самые свежие реплики, сколько влезает в бюджет, + новое сообщение."""
+    messages: List[Dict[str, str]] = [{"role": "system", "content": system_prompt}]
+    if summary:
+        summary = summary[: LLM_SUMMARY_TOKEN_LIMIT * 3]
+        messages.append({"role": "system", "content": "Краткое содержание предыдущего разговора:\n" + summary})
+    recent: List[Dict[str, str]] = []
+    used = 0
+    for item in reversed(history):
+        cost = estimate_tokens(item.content)
+        if used + cost > budget:
+            break
+        recent.append({"role": item.role, "content": item.content})
+        used += cost
+    messages.extend(reversed(recent))
+    messages.append({"role": "user", "content": user_text})
+    return messages
+
+SUMMARY_SYSTEM = (
+    "Ты ведёшь краткое резюме разговора психолога с клиентом. Обнови резюме с учётом новых реплик: "
+    "факты о человеке, его темы, чувства, договорённости и шаги. Без оценок и диагнозов, "
+    "не больше 8 коротких пунктов, только текст резюме."
+)
+
+class ConversationSummarizer:
+    """Сворачивает реплики, выпавшие из окна CONVERSATION_HISTORY_LIMIT, в резюме пользователя — в фоне.
+
+    Реплики читаются из conversation_messages и удаляются в той же транзакции, что записывает
+    новое резюме и его границу folded_until_id, поэтому реплика исчезает, только когда уже
+    попала в резюме; неудачная свёртка ничего не теряет. Отложенных пользователей заново
+    ставит в очередь следующий проход HistoryCompactor, а stop() при остановке бота можно
+    прервать любую свёртку: незакоммиченная просто повторится после перезапуска.
+    """
+
+    def __init__(self, batch_size: int) -> None:
+        self.batch_size = max(1, batch_size)
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self.refreshed = 0
+        self.failed = 0
+        self.turns_folded = 0
+
+    def schedule(self, user_id: int) -> None:
+        if not DEEPSEEK_API_KEY:
+            return
+        if user_id not in self._tasks:
+            self._tasks[user_id] = asyncio.create_task(self._run(user_id))
+
+    async def _run(self, user_id: int) -> None:
+        try:
+            while True:
+                folded = await self._fold(user_id)
+                if folded is None:
+                    # LLM занят или недоступен — реплики остаются в БД, повтор через HISTORY_COMPACTION_INTERVAL
+                    self.failed += 1
+                    break
+                if not folded:
+                    break
+        except Exception:
+            logger.exception("Не удалось обновить резюме разговора пользователя %s", user_id)
+        finally:
+            self._tasks.pop(user_id, None)
+
+    async def _fold(self, user_id: int) -> Optional[int]:
+        """Сворачивает самые старые реплики за окном; возвращает их число, None — LLM сейчас недоступен."""
+        async with SessionLocal() as s:
+            row = (await s.execute(
+                select(ConversationSummary).where(ConversationSummary.user_id == user_id)
+            )).scalar_one_or_none()
+            watermark = (row.folded_until_id or 0) if row else 0
+            # самая новая реплика за пределами окна (id растут в порядке записи)
+            stale_until = (await s.execute(
+                select(ConversationMessage.id)
+                .where(ConversationMessage.user_id == user_id)
+                .order_by(ConversationMessage.id.desc())
+                .offset(CONVERSATION_HISTORY_LIMIT)
+                .limit(1)
+            )).scalar_one_or_none()
+            if stale_until is None:
+                return 0
+            rows = (await s.execute(
+                select(ConversationMessage.id, ConversationMessage.role, ConversationMessage.content)
+                .where(ConversationMessage.user_id == user_id,
+                       ConversationMessage.id > watermark,
+                       ConversationMessage.id <= stale_until)
+                .order_by(ConversationMessage.id)
+                .limit(self.batch_size)
+            )).all()
+        turns = []
+        used = 0
+        for r in rows:
+            # за один запрос к LLM — не больше бюджета дословной истории, но хотя бы одна реплика
+            used += estimate_tokens(r.content)
+            if turns and used > LLM_HISTORY_TOKEN_BUDGET:
+                break
+            turns.append(r)
+        if not turns:
+            return 0
+        previous = row.summary if row else ""
+        dialogue = "\n".join(f"{'Клиент' if r.role == 'user' else 'Психолог'}: {r.content}" for r in turns)
+        prompt = [
+            {"role": "system", "content": SUMMARY_SYSTEM},
+            {"role": "user", "content": f"Текущее резюме:\n{previous or '(пока пусто)'}\n\nНовые реплики:\n{dialogue}"},
+        ]
+        try:
+            # фоновая работа идёт в самом конце очереди к LLM
+            async with llm_scheduler.slot(BACKGROUND_PRIORITY, deadline=60):
+                summary = await deepseek_reply(prompt, temperature=0.2, max_tokens=LLM_SUMMARY_TOKEN_LIMIT)
+        except (LLMQueueFull, LLMDeadlineExceeded):
+            return None
+        if summary in (LLM_FALLBACK_REPLY, LLM_NO_KEY_REPLY):
+            return None
+        async with session_scope() as s:
+            row = (await s.execute(
+                select(ConversationSummary).where(ConversationSummary.user_id == user_id)
+            )).scalar_one_or_none()
+            if row is None:
+                row = ConversationSummary(user_id=user_id, summary="", turns_folded=0, folded_until_id=0)
+                s.add(row)
+            elif (row.folded_until_id or 0) != watermark:
+                return 0  # резюме уже обновил другой процесс; эти реплики он учёл
+            row.summary = summary.strip()
+            row.turns_folded = (row.turns_folded or 0) + len(turns)
+            row.folded_until_id = turns[-1].id
+            await s.execute(delete(ConversationMessage).where(
+                ConversationMessage.user_id == user_id, ConversationMessage.id <= row.folded_until_id
+            ))
+        history_cache.set_summary(user_id, row.summary)
+        self.refreshed += 1
+        self.turns_folded += len(turns)
+        return len(turns)
+
+    async def stop(self) -> None:
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "refreshed": self.refreshed,
+            "postponed": self.failed,
+            "turns_folded": self.turns_folded,
+            "running": len(self._tasks),
+        }
+
+conversation_summaries = ConversationSummarizer(HISTORY_COMPACTION_BATCH)
+
+# -------------------------
+# 7.3 Кэш истории диалогов (write-through, LRU по пользователям)
+# -------------------------
+@dataclass(frozen=True)
+class HistoryItem:
+    role: str
+    content: str
+
+class _HistoryEntry:
+    __slots__ = ("items", "summary")
+
+    def __init__(self, items: List[HistoryItem], summary: Optional[str]) -> None:
+        self.items: deque = deque(items, maxlen=CONVERSATION_HISTORY_LIMIT)
+        self.summary = summary
+
+class HistoryCache:
+    """Последние CONVERSATION_HISTORY_LIMIT реплик и резюме для активных пользователей; при промахе читаем БД.
+
+    max_users=0 выключает кэш: каждый ход читает историю из БД.
+    """
+
+    def __init__(self, max_users: int) -> None:
+        self.max_users = max(0, max_users)
+        self._entries: "OrderedDict[int, _HistoryEntry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evicted_users = 0
+
+    def get(self, user_id: int) -> Optional[Tuple[List[HistoryItem], Optional[str]]]:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return list(entry.items), entry.summary
+
+    def put(self, user_id: int, items: List[HistoryItem], summary: Optional[str]) -> None:
+        if not self.max_users:
+            return
+        self._entries[user_id] = _HistoryEntry(items, summary)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+            self.evicted_users += 1
+
+    def append(self, user_id: int, items: List[HistoryItem]) -> None:
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            entry.items.extend(items)
+
+    def set_summary(self, user_id: int, summary: str) -> None:
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            entry.summary = summary
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "users": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evicted_users": self.evicted_users,
+        }
+
+history_cache = HistoryCache(0 if MULTI_WORKER_WEBHOOK else HISTORY_CACHE_USERS)
+
+# -------------------------
+# 7.4 Компактация истории: удаление реплик за пределами окна пачками, вне пути ответа
+# -------------------------
+class HistoryCompactor:
+    """Периодически находит пользователей, у которых реплик больше CONVERSATION_HISTORY_LIMIT.
+
+    Лишние реплики сворачивает в резюме и удаляет ConversationSummarizer; реплики, которые
+    не удалось свернуть, остаются в БД и подхватываются следующим проходом.
+    """
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self.runs = 0
+        self.users_scheduled = 0
+        self.seconds_total = 0.0
+        self.last_run_seconds = 0.0
+
+    async def run_once(self) -> int:
+        if not DEEPSEEK_API_KEY:
+            return 0  # свернуть нечем — реплики ждут в БД, пока не появится ключ
+        started = time.monotonic()
+        # один агрегирующий проход по таблице за запуск; дальше работа идёт по индексу user_id
+        over_limit = (
+            select(ConversationMessage.user_id)
+            .group_by(ConversationMessage.user_id)
+            .having(func.count() > CONVERSATION_HISTORY_LIMIT)
+        )
+        async with SessionLocal() as s:
+            user_ids = (await s.execute(over_limit)).scalars().all()
+        for user_id in user_ids:
+            conversation_summaries.schedule(user_id)
+        self.runs += 1
+        self.users_scheduled += len(user_ids)
+        self.last_run_seconds = time.monotonic() - started
+        self.seconds_total += self.last_run_seconds
+        return len(user_ids)
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Компактация истории диалогов не удалась")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "runs": self.runs,
+            "users_scheduled": self.users_scheduled,
+            "seconds_total": round(self.seconds_total, 3),
+            "last_run_seconds": round(self.last_run_seconds, 3),
+        }
+
+history_compactor = HistoryCompactor(HISTORY_COMPACTION_INTERVAL)
+
+# -------------------------
+# 7.5 Суточные квоты тарифов
+# -------------------------
+# KEYS[1] — счётчик пользователя за сутки; ARGV: лимит (-1 — без ограничения), TTL ключа (сек).
+# Ответ: новый счётчик или -1.
+QUOTA_LUA = """
+local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+local limit = tonumber(ARGV[1])
+if limit >= 0 and used >= limit then
+    return -1
+end
+used = redis.call('INCR', KEYS[1])
+if used == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return used
+"""
+
+def daily_request_limit(plan: Optional[str]) -> Optional[int]:
+    """Суточный лимит запросов к LLM; None — без ограничения.
+
+    Лимит тарифа действует, только когда в users.plan записан код из TARIFF_PLANS;
+    для остальных — FREE_DAILY_REQUESTS, если он задан.
+    """
+    tariff = TARIFF_PLANS.get(plan or "")
+    if tariff:
+        return tariff["daily_requests"]
+    return FREE_DAILY_REQUESTS or None
+
+class QuotaMeter:
+    """Суточные счётчики запросов к LLM: проверка в памяти (или одним скриптом в Redis) без чтения БД.
+
+    Изменённые счётчики периодически сбрасываются в usage_counters; при старте
+    сегодняшние значения подгружаются обратно, поэтому перезапуск не обнуляет квоту.
+    """
+
+    def __init__(self, flush_interval: float) -> None:
+        self.flush_interval = flush_interval
+        self._day = date.today()
+        self._used: Dict[int, int] = {}
+        self._dirty: Set[int] = set()
+        self._pending: Dict[Tuple[date, int], int] = {}  # счётчики прошлых суток, ещё не записанные в БД
+        self._script = _redis.register_script(QUOTA_LUA) if _redis else None
+        self._task: Optional[asyncio.Task] = None
+        self.allowed = 0
+        self.rejected = 0
+        self.flushes = 0
+        self.rows_flushed = 0
+
+    def _roll_day(self) -> None:
+        today = date.today()
+        if today == self._day:
+            return
+        for user_id in self._dirty:
+            self._pending[(self._day, user_id)] = self._used[user_id]
+        self._day = today
+        self._used.clear()
+        self._dirty.clear()
+
+    def _redis_key(self, user_id: int) -> str:
+        return f"quota:{self._day.isoformat()}:{user_id}"
+
+    async def remaining(self, user_id: int, plan: Optional[str]) -> Optional[int]:
+        self._roll_day()
+        limit = daily_request_limit(plan)
+        if limit is None:
+            return None
+        used = self._used.get(user_id, 0)
+        if _redis:
+            # счётчик общий для всех воркеров — берём из Redis
+            used = int(await _redis.get(self._redis_key(user_id)) or used)
+        return max(0, limit - used)
+
+    async def try_consume(self, user_id: int, plan: Optional[str]) -> bool:
+        """Списывает один запрос, если квота не исчерпана. Вызывать до обращения к LLM."""
+        self._roll_day()
+        limit = daily_request_limit(plan)
+        if self._script is not None:
+            used = int(await self._script(keys=[self._redis_key(user_id)],
+                                          args=[-1 if limit is None else limit, 2 * 86400]))
+            ok = used >= 0
+        else:
+            used = self._used.get(user_id, 0) + 1
+            ok = limit is None or used <= limit
+        if not ok:
+            self.rejected += 1
+            return False
+        self._used[user_id] = used
+        self._dirty.add(user_id)
+        self.allowed += 1
+        return True
+
+    async def refund(self, user_id: int) -> None:
+        """Возвращает запрос, если LLM не дала ответа (очередь переполнена, ошибка, ход отменён)."""
+        self._roll_day()
+        used = self._used.get(user_id, 0)
+        if used <= 0:
+            return
+        self._used[user_id] = int(await _redis.decr(self._redis_key(user_id))) if _redis else used - 1
+        self._dirty.add(user_id)
+        self.allowed -= 1
+
+    async def load_today(self) -> None:
+        """Подгружает сегодняшние счётчики из БД (и досеивает Redis, если его ключи пропали)."""
+        self._roll_day()
+        async with SessionLocal() as s:
+            rows = (await s.execute(
+                select(UsageCounter.user_id, UsageCounter.requests).where(UsageCounter.day == self._day)
+            )).all()
+        for row in rows:
+            self._used[row.user_id] = max(self._used.get(row.user_id, 0), row.requests)
+        if _redis and rows:
+            async with _redis.pipeline(transaction=False) as pipe:
+                for row in rows:
+                    pipe.set(self._redis_key(row.user_id), row.requests, nx=True, ex=2 * 86400)
+                await pipe.execute()
+
+    async def flush(self) -> int:
+        self._roll_day()
+        batch = dict(self._pending)
+        for user_id in self._dirty:
+            batch[(self._day, user_id)] = self._used[user_id]
+        if not batch:
+            return 0
+        self._pending.clear()
+        self._dirty.clear()
+        try:
+            async with session_scope() as s:
+                for day in {d for d, _ in batch}:
+                    user_ids = [u for d, u in batch if d == day]
+                    existing = {
+                        c.user_id: c for c in (await s.execute(
+                            select(UsageCounter).where(UsageCounter.day == day, UsageCounter.user_id.in_(user_ids))
+                        )).scalars()
+                    }
+                    for user_id in user_ids:
+                        used = batch[(day, user_id)]
+                        if user_id in existing:
+                            existing[user_id].requests = max(existing[user_id].requests, used)
+                        else:
+                            s.add(UsageCounter(user_id=user_id, day=day, requests=used))
+        except Exception:
+            # вернём в очередь, чтобы не потерять при следующем сбросе
+            for (day, user_id), used in batch.items():
+                if day == self._day:
+                    self._dirty.add(user_id)
+                else:
+                    self._pending[(day, user_id)] = used
+            raise
+        self.flushes += 1
+        self.rows_flushed += len(batch)
+        return len(batch)
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Сброс счётчиков квот в БД не удался")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "users_today": len(self._used),
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+            "dirty": len(self._dirty) + len(self._pending),
+            "flushes": self.flushes,
+            "rows_flushed": self.rows_flushed,
+        }
+
+quota_meter = QuotaMeter(QUOTA_FLUSH_INTERVAL)
+
+QUOTA_EXHAUSTED_REPLY = (
+    "На сегодня лимит сообщений по вашему тарифу исчерпан 🌙 Завтра счётчик обнулится. "
+    "Посмотреть остаток и тарифы можно в разделе /account."
+)
 
 # -------------------------
 # 8) TELEGRAM-БОТ (aiogram 3)
 # -------------------------
-from aiogram import Bot, Dispatcher, Router, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, F
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
 from aiogram.types import (
-    Message, BotCommand,
+    Message, BotCommand, TelegramObject, Update,
     KeyboardButton, ReplyKeyboardMarkup,
     InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, FSInputFile,
     BotCommandScopeDefault, BotCommandScopeAllPrivateChats,
 )
+from aiogram.dispatcher.event.bases import SkipHandler
+from aiogram.dispatcher.event.handler import CallableObject
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+class SqlStorage(BaseStorage):
+    """FSM-хранилище в основной БД бота (таблица fsm_states) с TTL: переживает перезапуск и общее для воркеров."""
+
+    def __init__(self, ttl: int) -> None:
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_destiny=True)
+
+    async def _load(self, key: StorageKey) -> Optional[FsmRecord]:
+        async with SessionLocal() as s:
+            record = await s.get(FsmRecord, self.key_builder.build(key))
+        if record is None or record.expires_at < time.time():
+            return None
+        return record
+
+    async def _save(self, key: StorageKey, **fields: Any) -> None:
+        async with session_scope() as s:
+            record = await s.get(FsmRecord, self.key_builder.build(key))
+            if record is None:
+                record = FsmRecord(key=self.key_builder.build(key), state=None, data={})
+                s.add(record)
+            elif record.expires_at < time.time():
+                record.state, record.data = None, {}
+            for name, value in fields.items():
+                setattr(record, name, value)
+            if record.state is not None or record.data:
+                record.expires_at = time.time() + self.ttl
+            elif record in s.new:
+                # очистка ключа, которого в БД нет (не сохранялся или истёк и уже удалён)
+                s.expunge(record)
+            else:
+                await s.delete(record)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._save(key, state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = await self._load(key)
+        return record.state if record else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._save(key, data=dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = await self._load(key)
+        return dict(record.data or {}) if record else {}
+
+    async def purge_expired(self) -> int:
+        async with session_scope() as s:
+            result = await s.execute(delete(FsmRecord).where(FsmRecord.expires_at < time.time()))
+        return result.rowcount or 0
+
+    async def close(self) -> None:
+        pass
+
+def build_fsm_storage() -> BaseStorage:
+    if FSM_STORAGE == "redis" and REDIS_URL:
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(REDIS_URL, state_ttl=FSM_STATE_TTL, data_ttl=FSM_STATE_TTL)
+    if FSM_STORAGE == "sql":
+        return SqlStorage(FSM_STATE_TTL)
+    if FSM_STORAGE == "redis":
+        logger.warning("FSM_STORAGE=redis без REDIS_URL — состояние FSM хранится в памяти процесса")
+    return MemoryStorage()
+
+class UserLaneIsolation(BaseEventIsolation):
+    """Апдейты одного пользователя обрабатываются по очереди, разных — параллельно, но не больше max_in_flight сразу.
+
+    Подключается как events_isolation диспетчера: aiogram берёт эту блокировку до чтения
+    состояния FSM, поэтому следующий апдейт пользователя видит состояние, записанное предыдущим.
+    Полоса (lock) пользователя живёт, пока в ней есть хоть один апдейт, и удаляется
+    последним вышедшим, поэтому простаивающие полосы память не занимают.
+    """
+
+    def __init__(self, max_in_flight: int) -> None:
+        self._slots = asyncio.Semaphore(max(1, max_in_flight))
+        self._lanes: Dict[int, Tuple[asyncio.Lock, List[int]]] = {}  # user_id -> (lock, [апдейтов в полосе])
+        self.in_flight = 0
+        self.max_lanes = 0
+        self.queued = 0  # сколько апдейтов ждали свою очередь в полосе пользователя
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey) -> AsyncIterator[None]:
+        lock, users = self._lanes.setdefault(key.user_id, (asyncio.Lock(), [0]))
+        users[0] += 1
+        self.max_lanes = max(self.max_lanes, len(self._lanes))
+        if lock.locked():
+            self.queued += 1
+        try:
+            # сначала очередь пользователя, потом общий слот: ждущие в полосе не занимают слоты
+            async with lock, self._slots:
+                self.in_flight += 1
+                try:
+                    yield
+                finally:
+                    self.in_flight -= 1
+        finally:
+            users[0] -= 1
+            if users[0] == 0:
+                del self._lanes[key.user_id]
+
+    async def close(self) -> None:
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "lanes": len(self._lanes),
+            "max_lanes": self.max_lanes,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+        }
+
+user_lanes = UserLaneIsolation(UPDATE_MAX_IN_FLIGHT)
 
 bot = Bot(token=TELEGRAM_BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN))
-dp = Dispatcher()
+dp = Dispatcher(storage=build_fsm_storage(), events_isolation=user_lanes)
+
+class DbSessionMiddleware(BaseMiddleware):
+    """Одна сессия и одна транзакция на апдейт: обработчики получают её аргументом `session`."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        async with session_scope() as session:
+            data["session"] = session
+            return await handler(event, data)
+
+@asynccontextmanager
+async def _unit_of_work(session: Optional[AsyncSession]) -> AsyncIterator[AsyncSession]:
+    # внутри апдейта используем его сессию (commit сделает middleware), иначе — свою короткую транзакцию
+    if session is not None:
+        yield session
+        return
+    async with session_scope() as s:
+        yield s
+
+class TextRouteTable:
+    """Текстовые кнопки и команды меню: один поиск в dict вместо цепочки фильтров по всем роутерам.
+
+    Ключ — текст без пробелов по краям и без учёта регистра; у команд берётся первое слово
+    без `@имя_бота` (`/start ref123` → `/start`). Текст, не найденный в таблице, уходит
+    обработчику, зарегистрированному для текущего состояния FSM (`None` — без состояния).
+    Обработчики получают только те аргументы, которые объявили, как и в aiogram.
+    """
+
+    def __init__(self) -> None:
+        self._routes: Dict[str, Callable[..., Awaitable[Any]]] = {}
+        self._fallbacks: Dict[Optional[str], Callable[..., Awaitable[Any]]] = {}
+        self._compiled: Dict[str, CallableObject] = {}
+        self._compiled_fallbacks: Dict[Optional[str], CallableObject] = {}
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        key = text.strip()
+        if key.startswith("/"):
+            key = key.split(maxsplit=1)[0].split("@", 1)[0]
+        return key.casefold()
+
+    def route(self, *labels: str):
+        def decorator(handler):
+            for label in labels:
+                key = self.normalize(label)
+                if key in self._routes:
+                    raise ValueError(f"Текст {label!r} уже привязан к {self._routes[key].__name__}")
+                self._routes[key] = handler
+            return handler
+        return decorator
+
+    def fallback(self, state: Optional[State] = None):
+        def decorator(handler):
+            self._fallbacks[state.state if state else None] = handler
+            return handler
+        return decorator
+
+    def compile(self) -> None:
+        self._compiled = {key: CallableObject(handler) for key, handler in self._routes.items()}
+        self._compiled_fallbacks = {key: CallableObject(handler) for key, handler in self._fallbacks.items()}
+
+    def __contains__(self, text: str) -> bool:
+        return self.normalize(text) in self._routes
+
+    async def dispatch(self, message: Message, data: Dict[str, Any]) -> Any:
+        handler = self._compiled.get(self.normalize(message.text))
+        if handler is None:
+            handler = self._compiled_fallbacks.get(data.get("raw_state"))
+            if handler is None:
+                raise SkipHandler()
+        return await handler.call(message, **data)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"routes": len(self._compiled), "fallbacks": len(self._compiled_fallbacks)}
+
+text_routes = TextRouteTable()
+text_router = Router()
+
+@text_router.message(F.text)
+async def route_text(message: Message, **data: Any):
+    return await text_routes.dispatch(message, data)
 
 BOT_COMMANDS: List[BotCommand] = [
     BotCommand(command="start", description="Перезапустить бота"),
@@ -878,29 +2182,122 @@ MAIN_KB = ReplyKeyboardMarkup(
 # -------------------------
 # 8.1 Старт и меню + обработка deep-link /start ref<code>
 # -------------------------
-start_router = Router()
 
 async def _ensure_user(tg_id: int, username: Optional[str]) -> "User":
     # Оставлено для обратной совместимости других обработчиков
     async with SessionLocal() as s:
-        user = (await s.execute(select(User).where(User.tg_id == str(tg_id)))).scalar_one_or_none()
+        user = (await s.execute(select(User).where(User.tg_id == tg_id))).scalar_one_or_none()
         if not user:
-            user = User(tg_id=str(tg_id), username=username or "", persona="pro_psychologist")
+            user = User(tg_id=tg_id, username=username or "", persona="pro_psychologist")
             s.add(user)
             await s.commit()
         return user
 
-async def ensure_user_with_flag(tg_id: int, username: Optional[str]) -> Tuple["User", bool]:
-    async with SessionLocal() as s:
-        user = (await s.execute(select(User).where(User.tg_id == str(tg_id)))).scalar_one_or_none()
+async def ensure_user_with_flag(tg_id: int, username: Optional[str],
+                                session: Optional[AsyncSession] = None) -> Tuple["User", bool]:
+    async with _unit_of_work(session) as s:
+        user = (await s.execute(select(User).where(User.tg_id == tg_id))).scalar_one_or_none()
         created = False
         if not user:
-            user = User(tg_id=str(tg_id), username=username or "", persona="pro_psychologist")
+            user = User(tg_id=tg_id, username=username or "", persona="pro_psychologist")
             s.add(user)
-            await s.commit()
+            await s.flush()
             created = True
         return user, created
 
+@dataclass(frozen=True)
+class UserIdentity:
+    id: int
+    persona: str
+    plan: str
+    username: str
+
+class UserIdentityCache:
+    """TTL + LRU кэш идентичности пользователя по Telegram id: избавляет от SELECT users на каждом апдейте.
+
+    max_size=0 выключает кэш. Запись в users сбрасывает запись кэша только после commit
+    (`invalidate_after_commit`), а чтения, начатые до сброса, не кладут в кэш то, что прочитали.
+    """
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max(0, max_size)
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, Tuple[float, UserIdentity]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._epoch = 0  # растёт при каждом сбросе
+
+    @property
+    def epoch(self) -> int:
+        return self._epoch
+
+    def get(self, tg_id: int, username: Optional[str] = None) -> Optional[UserIdentity]:
+        entry = self._entries.get(tg_id)
+        if entry is None or entry[0] < time.monotonic() or (username and entry[1].username != username):
+            if entry is not None:
+                del self._entries[tg_id]  # просрочена или пользователь сменил username
+            self.misses += 1
+            return None
+        self._entries.move_to_end(tg_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, tg_id: int, identity: UserIdentity, epoch: Optional[int] = None) -> None:
+        # epoch — значение self.epoch до чтения из БД: если с тех пор был сброс, прочитанное могло устареть
+        if not self.max_size or (epoch is not None and epoch != self._epoch):
+            return
+        self._entries[tg_id] = (time.monotonic() + self.ttl, identity)
+        self._entries.move_to_end(tg_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, tg_id: int) -> None:
+        """Вызывать после commit любой записи в users (персона, тариф, username)."""
+        self._epoch += 1
+        if self._entries.pop(tg_id, None) is not None:
+            self.invalidations += 1
+
+    def invalidate_after_commit(self, session: AsyncSession, tg_id: int) -> None:
+        # до commit параллельный апдейт ещё читает из БД старую запись и положил бы её в кэш
+        event.listen(session.sync_session, "after_commit", lambda _: self.invalidate(tg_id), once=True)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+identity_cache = UserIdentityCache(0 if MULTI_WORKER_WEBHOOK else IDENTITY_CACHE_SIZE, IDENTITY_CACHE_TTL)
+
+async def get_user_identity(tg_id: int, username: Optional[str] = None,
+                            session: Optional[AsyncSession] = None) -> UserIdentity:
+    """Идентичность пользователя из кэша; при промахе — из БД (пользователь создаётся, username обновляется)."""
+    identity = identity_cache.get(tg_id, username)
+    if identity is not None:
+        return identity
+    epoch = identity_cache.epoch
+    created = False
+    async with _unit_of_work(session) as s:
+        user = (await s.execute(select(User).where(User.tg_id == tg_id))).scalar_one_or_none()
+        if not user:
+            user = User(tg_id=tg_id, username=username or "", persona="pro_psychologist")
+            s.add(user)
+            await s.flush()
+            created = True
+        elif username and user.username != username:
+            # обновим username при смене
+            user.username = username
+    identity = UserIdentity(id=user.id, persona=user.persona, plan=user.plan, username=user.username or "")
+    if not (created and session is not None):
+        # нового пользователя из чужой транзакции не кэшируем: её ещё могут откатить
+        identity_cache.put(tg_id, identity, epoch)
+    return identity
+
 # --- Реферальные хелперы ---
 _DIGITS36 = "0123456789abcdefghijklmnopqrstuvwxyz"
 def _to_base36(n: int) -> str:
@@ -929,82 +2326,132 @@ def parse_ref_code(code: str) -> Optional[int]:
     except Exception:
         return None
 
-async def record_referral(referrer_tg_id: int, referred_tg_id: int, code: str, status: str):
+REFERRAL_COUNTED_STATUSES = ("clicked", "joined", "paid")
+
+async def _bump_referral_counters(s: AsyncSession, user_tg_id: int, deltas: Dict[str, int]) -> None:
+    # upsert в той же транзакции, что и запись в referrals/user_bonuses: строка появляется с первой записью
+    deltas = {column: delta for column, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    dialect_insert = postgresql.insert if s.bind.dialect.name == "postgresql" else sqlite.insert
+    stmt = dialect_insert(ReferralCounter).values(user_tg_id=user_tg_id, **deltas)
+    await s.execute(stmt.on_conflict_do_update(
+        index_elements=[ReferralCounter.user_tg_id],
+        set_={
+            **{column: getattr(ReferralCounter, column) + stmt.excluded[column] for column in deltas},
+            "updated_at": func.now(),
+        },
+    ))
+
+def _status_deltas(old: Optional[str], new: str) -> Dict[str, int]:
+    deltas: Dict[str, int] = {}
+    if old in REFERRAL_COUNTED_STATUSES:
+        deltas[old] = -1
+    if new in REFERRAL_COUNTED_STATUSES:
+        deltas[new] = deltas.get(new, 0) + 1
+    return deltas
+
+async def get_referral_counters(user_tg_id: int, session: Optional[AsyncSession] = None) -> ReferralCounter:
+    """Сводка рефералов и бонусных дней пользователя: одна строка по ключу; нет строки — нет рефералов и бонусов.
+
+    Строки для данных, записанных до появления таблицы, создаёт migrations/referral_counters.py.
+    """
+    async with _unit_of_work(session) as s:
+        counters = await s.get(ReferralCounter, user_tg_id)
+    return counters or ReferralCounter(user_tg_id=user_tg_id, clicked=0, joined=0, paid=0, bonus_days=0)
+
+async def referral_counters_missing() -> bool:
+    """Есть рефералы или бонусы, но ни одной строки счётчиков — база не прошла migrations/referral_counters.py."""
     async with SessionLocal() as s:
+        has_counters = (await s.execute(select(ReferralCounter.user_tg_id).limit(1))).first() is not None
+        if has_counters:
+            return False
+        has_referrals = (await s.execute(select(Referral.id).limit(1))).first() is not None
+        has_bonuses = (await s.execute(select(UserBonus.id).limit(1))).first() is not None
+    return has_referrals or has_bonuses
+
+async def record_referral(referrer_tg_id: int, referred_tg_id: int, code: str, status: str,
+                          session: Optional[AsyncSession] = None):
+    async with _unit_of_work(session) as s:
         # проверим, есть ли запись пары
         existing = (await s.execute(
             select(Referral).where(
-                Referral.referrer_tg_id == str(referrer_tg_id),
-                Referral.referred_tg_id == str(referred_tg_id)
+                Referral.referrer_tg_id == referrer_tg_id,
+                Referral.referred_tg_id == referred_tg_id
             )
         )).scalar_one_or_none()
         if existing:
             # Обновим статус, если стало «лучше» (clicked -> joined -> paid)
             order = {"invalid":0, "self":0, "clicked":1, "joined":2, "paid":3}
             if order.get(status, 0) > order.get(existing.status, 0):
+                await _bump_referral_counters(s, referrer_tg_id, _status_deltas(existing.status, status))
                 existing.status = status
-            await s.commit()
         else:
-            s.add(Referral(code=code, referrer_tg_id=str(referrer_tg_id),
-                           referred_tg_id=str(referred_tg_id), status=status))
-            await s.commit()
-    await log_event(str(referred_tg_id), "referral_"+status, {"referrer": str(referrer_tg_id), "code": code})
-
-async def grant_bonus(user_tg_id: int, bonus_type: str, days: int, activated: bool = True, payload: Optional[dict] = None):
-    async with SessionLocal() as s:
-        s.add(UserBonus(user_tg_id=str(user_tg_id), type=bonus_type, days=days, activated=activated,
+            s.add(Referral(code=code, referrer_tg_id=referrer_tg_id,
+                           referred_tg_id=referred_tg_id, status=status))
+            await _bump_referral_counters(s, referrer_tg_id, _status_deltas(None, status))
+    await log_event(referred_tg_id, "referral_"+status, {"referrer": str(referrer_tg_id), "code": code})
+
+async def grant_bonus(user_tg_id: int, bonus_type: str, days: int, activated: bool = True, payload: Optional[dict] = None,
+                      session: Optional[AsyncSession] = None):
+    async with _unit_of_work(session) as s:
+        s.add(UserBonus(user_tg_id=user_tg_id, type=bonus_type, days=days, activated=activated,
                         payload=payload or {}, activated_at=func.now() if activated else None))
-        await s.commit()
-    await log_event(str(user_tg_id), "bonus_granted", {"type": bonus_type, "days": days, "activated": activated})
+        if activated:
+            await _bump_referral_counters(s, user_tg_id, {"bonus_days": days})
+    await log_event(user_tg_id, "bonus_granted", {"type": bonus_type, "days": days, "activated": activated})
 
-async def activate_referral_reward_for_payer(payer_tg_id: int):
+async def activate_referral_reward_for_payer(payer_tg_id: int, session: Optional[AsyncSession] = None):
     # Найти последнюю referral (joined/clicked) и начислить пригласившему бонус REF_BONUS_DAYS_PAID
-    async with SessionLocal() as s:
+    async with _unit_of_work(session) as s:
         ref = (await s.execute(
             select(Referral).where(
-                Referral.referred_tg_id == str(payer_tg_id),
+                Referral.referred_tg_id == payer_tg_id,
                 Referral.status.in_(("joined","clicked"))
             ).order_by(Referral.created_at.desc())
         )).scalars().first()
         if not ref:
             return False
         # обновим статус → paid
+        await _bump_referral_counters(s, ref.referrer_tg_id, _status_deltas(ref.status, "paid"))
         ref.status = "paid"
-        await s.commit()
-    # начислим пригласившему
-    await grant_bonus(int(ref.referrer_tg_id), "ref_paid", REF_BONUS_DAYS_PAID, activated=True, payload={"from": str(payer_tg_id)})
+        # начислим пригласившему
+        await grant_bonus(ref.referrer_tg_id, "ref_paid", REF_BONUS_DAYS_PAID, activated=True,
+                          payload={"from": str(payer_tg_id)}, session=s)
     try:
-        await bot.send_message(int(ref.referrer_tg_id),
+        await bot.send_message(ref.referrer_tg_id,
                                f"🎉 Друг совершил оплату — +{REF_BONUS_DAYS_PAID} дней к вашему доступу (бонус реферала).")
     except Exception:
         pass
     return True
 
-@start_router.message(F.text.startswith("/start"))
-async def cmd_start(message: Message):
+@text_routes.route("/start")
+async def cmd_start(message: Message, session: AsyncSession):
     # Разберём payload у /start (deep-link)
     payload = ""
     parts = message.text.split(maxsplit=1)
     if len(parts) > 1:
         payload = parts[1].strip()
 
-    user, created = await ensure_user_with_flag(message.from_user.id, message.from_user.username)
+    user, created = await ensure_user_with_flag(message.from_user.id, message.from_user.username, session=session)
 
     # Реферальная обработка: /start ref<code>
     if payload.startswith("ref"):
         code = payload[3:]
         referrer_tg_id = parse_ref_code(code)
         if not referrer_tg_id:
-            await record_referral(0, message.from_user.id, code, "invalid")
+            await record_referral(0, message.from_user.id, code, "invalid", session=session)
             await message.answer("Кажется, реферальная ссылка некорректна. Но ничего — можно пользоваться ботом и так 💛")
         elif int(referrer_tg_id) == int(message.from_user.id):
-            await record_referral(referrer_tg_id, message.from_user.id, code, "self")
+            await record_referral(referrer_tg_id, message.from_user.id, code, "self", session=session)
             await message.answer("Нельзя пригласить самого себя 😊 Отправьте ссылку друзьям.")
         else:
-            await record_referral(referrer_tg_id, message.from_user.id, code, "joined" if created else "clicked")
+            await record_referral(referrer_tg_id, message.from_user.id, code, "joined" if created else "clicked",
+                                  session=session)
             if created:
                 # бонус приглашённому сразу
-                await grant_bonus(message.from_user.id, "ref_join", REF_BONUS_DAYS_JOINED, activated=True, payload={"referrer": str(referrer_tg_id)})
+                await grant_bonus(message.from_user.id, "ref_join", REF_BONUS_DAYS_JOINED, activated=True,
+                                  payload={"referrer": str(referrer_tg_id)}, session=session)
                 try:
                     await bot.send_message(int(referrer_tg_id),
                                            "📣 По вашей ссылке зарегистрировался новый пользователь. "
@@ -1019,9 +2466,9 @@ async def cmd_start(message: Message):
         "Выберите действие ниже 👇",
         reply_markup=MAIN_KB,
     )
-    await log_event(str(message.from_user.id), "menu_open", {"source": "start"})
+    await log_event(message.from_user.id, "menu_open", {"source": "start"})
 
-@start_router.message(F.text == "/menu")
+@text_routes.route("/menu")
 async def cmd_menu(message: Message):
     await message.answer("Выберите действие ниже 👇", reply_markup=MAIN_KB)
 
@@ -1038,114 +2485,240 @@ PERSONA_KB = InlineKeyboardMarkup(
     ]
 )
 
-@persona_router.message(F.text.in_({"🎭 Персонаж", "/persona"}))
+@text_routes.route("🎭 Персонаж", "/persona")
 async def select_persona(message: Message):
     await message.answer("Кем мне быть для вас в диалоге?", reply_markup=PERSONA_KB)
 
 @persona_router.callback_query(F.data.startswith("persona:"))
-async def set_persona(cb: CallbackQuery):
+async def set_persona(cb: CallbackQuery, session: AsyncSession):
     persona = cb.data.split(":")[1]
-    async with SessionLocal() as s:
-        user = (await s.execute(select(User).where(User.tg_id == str(cb.from_user.id)))).scalar_one()
-        user.persona = persona
-        await s.commit()
+    user = (await session.execute(select(User).where(User.tg_id == cb.from_user.id))).scalar_one()
+    user.persona = persona
+    identity_cache.invalidate_after_commit(session, cb.from_user.id)
     await cb.message.edit_text(f"Готово! Выбрана роль: {PERSONAS[persona]['title']}")
-    await log_event(str(cb.from_user.id), "persona_set", {"persona": persona})
+    await log_event(cb.from_user.id, "persona_set", {"persona": persona})
     await cb.answer("Супер!")
 
 # -------------------------
 # 8.3 Сессия (диалог)
 # -------------------------
-session_router = Router()
-
-@session_router.message(F.text == "🧠 Сессия")
-@session_router.message(F.text == "/session")
+@text_routes.route("🧠 Сессия", "/session")
 async def session_greet(message: Message):
     await message.answer("Начнём. Что сейчас важнее всего — мысль, чувство или ситуация?")
 
-@session_router.message(
-F.text & ~F.text.in_({
-    "🧠 Сессия",
-    "🎭 Персонаж",
-    "✅ Чек-ин",
-    "🧪 Шкалы",
-    "Шкалы",
-    "шкалы",
-    "/tests",
-    "📝 Дневник",
-    "🆘 Ресурсы",
-    "Ресурсы",
-    "ресурсы",
-    "/resources",
-    "🧘 Медитации",
-    "💳 Подписка",
-    "Подписка",
-    "подписка",
-    "/account",
-    "💌 Пригласить друга",
-    "👥 Рефералы",
-})
-)
+TELEGRAM_TEXT_LIMIT = 4096
+
+async def _edit_stream_message(target: Message, text: str, parse_mode: Any = None) -> None:
+    try:
+        await target.edit_text(text[:TELEGRAM_TEXT_LIMIT], parse_mode=parse_mode)
+    except TelegramBadRequest as e:
+        if "not modified" in str(e):
+            return
+        if parse_mode is None:
+            raise
+        # недописанная/кривая Markdown-разметка — покажем текст как есть
+        await target.edit_text(text[:TELEGRAM_TEXT_LIMIT], parse_mode=None)
+
+async def _delete_quietly(target: Message) -> None:
+    try:
+        await target.delete()
+    except Exception:
+        pass
+
+async def stream_reply(message: Message, messages_payload: List[Dict[str, str]]) -> str:
+    """Отправляет заглушку и дописывает её по мере генерации; возвращает полный текст ответа."""
+    placeholder = await message.answer("…", parse_mode=None)
+    reply = ""
+    shown = ""
+    next_edit_at = 0.0
+    try:
+        async for delta in deepseek_stream(messages_payload):
+            reply += delta
+            now = time.monotonic()
+            if now < next_edit_at or not reply.strip() or reply == shown:
+                continue
+            try:
+                # промежуточные правки — без разметки: Markdown может быть ещё не закрыт
+                await _edit_stream_message(placeholder, reply)
+                shown = reply
+                next_edit_at = now + LLM_STREAM_EDIT_INTERVAL
+            except TelegramRetryAfter as e:
+                next_edit_at = now + e.retry_after
+            except TelegramBadRequest:
+                next_edit_at = now + LLM_STREAM_EDIT_INTERVAL
+    except asyncio.CancelledError:
+        # генерацию вытеснило более новое сообщение — уберём недописанный ответ
+        await _delete_quietly(placeholder)
+        raise
+    reply = reply.strip() or LLM_FALLBACK_REPLY
+    try:
+        await _edit_stream_message(placeholder, reply, parse_mode=ParseMode.MARKDOWN)
+    except TelegramRetryAfter as e:
+        await asyncio.sleep(e.retry_after)
+        await _edit_stream_message(placeholder, reply, parse_mode=ParseMode.MARKDOWN)
+    return reply
+
+@text_routes.fallback()
 async def talk(message: Message):
     # антиспам
-    if await rate_limited(message.from_user.id):
+    verdict = await antispam_check(message.from_user.id, message.text)
+    if verdict == ANTISPAM_RATE_LIMITED:
         return await message.answer("Хм, очень много сообщений подряд 🙈 Давайте по шагу…")
-    if await is_duplicate(message.from_user.id, message.text):
+    if verdict == ANTISPAM_DUPLICATE:
         return
     # кризис
     if detect_risk(message.text):
         await message.answer(CRISIS_TEXT)
-        await log_event(str(message.from_user.id), "crisis_detected", {"text": message.text})
+        await log_event(message.from_user.id, "crisis_detected", {"text": message.text})
         return
+    # сообщения, пришедшие подряд, объединяются в один ход диалога
+    await conversation_bursts.submit(message)
+
+@dataclass
+class ConversationTurn:
+    user_id: int
+    reply: str
+    delivered: bool  # ответ уже показан пользователю (потоковый режим)
+
+async def generate_turn(message: Message, text: str) -> Optional[ConversationTurn]:
     # роль пользователя
-    async with SessionLocal() as s:
-        user = (await s.execute(select(User).where(User.tg_id == str(message.from_user.id)))).scalar_one_or_none()
-        if not user:
-            user = User(tg_id=str(message.from_user.id), username=message.from_user.username or "", persona="pro_psychologist")
-            s.add(user)
-            await s.commit()
-            await s.refresh(user)
-        else:
-            # обновим username при смене
-            if message.from_user.username and user.username != message.from_user.username:
-                user.username = message.from_user.username
-                await s.commit()
-                await s.refresh(user)
-        history_stmt = (
-            select(ConversationMessage)
-            .where(ConversationMessage.user_id == user.id)
-            .order_by(ConversationMessage.created_at.desc(), ConversationMessage.id.desc())
-            .limit(CONVERSATION_HISTORY_LIMIT)
-        )
-        history = list(reversed((await s.execute(history_stmt)).scalars().all()))
-    persona_key = user.persona if user else "pro_psychologist"
-    system_prompt = PERSONAS[persona_key]["system"] + "\n\n" + STYLE_SYSTEM
-    # запрос к «мозгу»
-    messages_payload: List[Dict[str, str]] = [{"role": "system", "content": system_prompt}]
-    for item in history:
-        messages_payload.append({"role": item.role, "content": item.content})
-    messages_payload.append({"role": "user", "content": message.text})
-
-    reply = await deepseek_reply(messages_payload)
-    await message.answer(reply)
-    async with SessionLocal() as s:
-        s.add_all([
-            ConversationMessage(user_id=user.id, role="user", content=message.text),
-            ConversationMessage(user_id=user.id, role="assistant", content=reply),
-        ])
-        await s.flush()
-        extra_ids = (
-            await s.execute(
-                select(ConversationMessage.id)
+    user = await get_user_identity(message.from_user.id, message.from_user.username)
+    # квота проверяется до любой дорогой работы и до обращения к LLM
+    if not await quota_meter.try_consume(user.id, user.plan):
+        await message.answer(QUOTA_EXHAUSTED_REPLY)
+        await log_event(message.from_user.id, "quota_exhausted", {"plan": user.plan})
+        return None
+    cached = history_cache.get(user.id)
+    if cached is not None:
+        history, summary = cached
+    else:
+        async with SessionLocal() as s:
+            history_stmt = (
+                select(ConversationMessage.role, ConversationMessage.content)
                 .where(ConversationMessage.user_id == user.id)
                 .order_by(ConversationMessage.created_at.desc(), ConversationMessage.id.desc())
-                .offset(CONVERSATION_HISTORY_LIMIT)
+                .limit(CONVERSATION_HISTORY_LIMIT)
             )
-        ).scalars().all()
-        if extra_ids:
-            await s.execute(delete(ConversationMessage).where(ConversationMessage.id.in_(extra_ids)))
-        await s.commit()
-    await log_event(str(message.from_user.id), "ai_reply", {"len": len(reply)})
+            history = [HistoryItem(row.role, row.content) for row in reversed((await s.execute(history_stmt)).all())]
+            summary = (await s.execute(
+                select(ConversationSummary.summary).where(ConversationSummary.user_id == user.id)
+            )).scalar_one_or_none()
+        history_cache.put(user.id, history, summary)
+    persona_key = user.persona if user.persona in PERSONAS else "pro_psychologist"
+    system_prompt = PERSONAS[persona_key]["system"] + "\n\n" + STYLE_SYSTEM
+    # запрос к «мозгу»: резюме + свежие реплики в пределах бюджета токенов
+    messages_payload = build_prompt(system_prompt, summary, history, text)
+
+    try:
+        async with llm_scheduler.slot(plan_priority(user.plan)):
+            if LLM_STREAMING:
+                reply = await stream_reply(message, messages_payload)
+            else:
+                reply = await deepseek_reply(messages_payload)
+    except (LLMQueueFull, LLMDeadlineExceeded) as e:
+        await quota_meter.refund(user.id)
+        await message.answer(LLM_BUSY_REPLY)
+        await log_event(message.from_user.id, "llm_rejected", {"reason": type(e).__name__})
+        return None
+    except asyncio.CancelledError:
+        # ход вытеснен следующим сообщением — запрос войдёт в объединённый ход
+        await quota_meter.refund(user.id)
+        raise
+    if reply in (LLM_FALLBACK_REPLY, LLM_NO_KEY_REPLY):
+        # заглушка вместо ответа модели квоту не расходует
+        await quota_meter.refund(user.id)
+    return ConversationTurn(user_id=user.id, reply=reply, delivered=LLM_STREAMING)
+
+async def finish_turn(message: Message, text: str, turn: Optional[ConversationTurn]) -> None:
+    if turn is None:
+        return
+    if not turn.delivered:
+        await message.answer(turn.reply)
+    # write-through: кэш обновляется сразу; в БД реплики уходят через фоновую запись,
+    # лишние строки удалит фоновая компактация
+    history_cache.append(turn.user_id, [HistoryItem("user", text), HistoryItem("assistant", turn.reply)])
+    await conversation_writer.put(ConversationMessage, {"user_id": turn.user_id, "role": "user", "content": text})
+    await conversation_writer.put(ConversationMessage, {"user_id": turn.user_id, "role": "assistant", "content": turn.reply})
+    await log_event(message.from_user.id, "ai_reply", {"len": len(turn.reply)})
+
+class BurstCoalescer:
+    """Склеивает сообщения пользователя, пришедшие подряд в пределах окна, в один ход диалога.
+
+    Новое сообщение перезапускает окно и отменяет ещё не показанную генерацию — её текст
+    войдёт в следующий, объединённый ход. Ходы одного пользователя выполняются строго по очереди.
+    """
+
+    def __init__(
+        self,
+        window_ms: int,
+        generate: Callable[[Message, str], Awaitable[Any]],
+        finish: Callable[[Message, str, Any], Awaitable[None]],
+    ) -> None:
+        self.window = max(0, window_ms) / 1000
+        self._generate = generate
+        self._finish = finish
+        self._pending: Dict[int, List[Message]] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._delivering: Set[int] = set()
+        self.turns = 0
+        self.messages = 0
+        self.cancelled = 0
+
+    async def submit(self, message: Message) -> None:
+        uid = message.from_user.id
+        self._pending.setdefault(uid, []).append(message)
+        previous = self._tasks.get(uid)
+        if previous is not None and previous.done():
+            previous = None
+        if previous is not None and uid not in self._delivering:
+            previous.cancel()
+        self._tasks[uid] = asyncio.create_task(self._run(uid, previous))
+
+    async def _run(self, uid: int, previous: Optional[asyncio.Task]) -> None:
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            await asyncio.sleep(self.window)
+            batch = self._pending.pop(uid, [])
+            if not batch:
+                return
+            text = "\n".join(m.text for m in batch)
+            try:
+                result = await self._generate(batch[-1], text)
+            except asyncio.CancelledError:
+                # вернём сообщения в начало очереди — они войдут в следующий ход
+                self._pending[uid] = batch + self._pending.get(uid, [])
+                self.cancelled += 1
+                raise
+            self._delivering.add(uid)
+            self.turns += 1
+            self.messages += len(batch)
+            await self._finish(batch[-1], text, result)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Не удалось ответить на сообщение пользователя %s", uid)
+        finally:
+            self._delivering.discard(uid)
+            if self._tasks.get(uid) is asyncio.current_task():
+                del self._tasks[uid]
+
+    async def drain(self) -> None:
+        """Ждёт завершения уже начатых ходов (при остановке бота)."""
+        tasks = [t for t in self._tasks.values() if not t.done()]
+        if tasks:
+            await asyncio.wait(tasks)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "turns": self.turns,
+            "messages": self.messages,
+            "merged": self.messages - self.turns,
+            "cancelled_generations": self.cancelled,
+            "active_users": len(self._tasks),
+        }
+
+conversation_bursts = BurstCoalescer(LLM_BURST_WINDOW_MS, generate_turn, finish_turn)
 
 # -------------------------
 # 8.4 Чек-ин (настроение)
@@ -1156,45 +2729,45 @@ MOOD_KB = InlineKeyboardMarkup(
     inline_keyboard=[[InlineKeyboardButton(text=m, callback_data=f"mood:{i}")] for i, m in enumerate(MOODS)]
 )
 
-@checkin_router.message(F.text.in_({"✅ Чек-ин", "/checkin"}))
+@text_routes.route("✅ Чек-ин", "/checkin")
 async def checkin(message: Message):
     await message.answer("Как вы сейчас? Выберите состояние:", reply_markup=MOOD_KB)
 
 @checkin_router.callback_query(F.data.startswith("mood:"))
-async def mood_selected(cb: CallbackQuery):
+async def mood_selected(cb: CallbackQuery, session: AsyncSession):
     idx = int(cb.data.split(":")[1])
     mood = MOODS[idx]
-    async with SessionLocal() as s:
-        user_id = (await s.execute(sqltext("SELECT id FROM users WHERE tg_id=:t"), {"t": str(cb.from_user.id)})).scalar_one()
-        s.add(JournalEntry(user_id=user_id, mood=mood, text=None))
-        await s.commit()
+    user = await get_user_identity(cb.from_user.id, session=session)
+    session.add(JournalEntry(user_id=user.id, mood=mood, text=None))
     await cb.message.edit_text(f"Сохранила: {mood}. Если хотите, добавьте пару слов — это помогает замечать паттерны.")
-    await log_event(str(cb.from_user.id), "checkin_saved", {"mood": mood})
+    await log_event(cb.from_user.id, "checkin_saved", {"mood": mood})
     await cb.answer("Готово")
 
 # -------------------------
 # 8.5 Дневник (5 минут после команды)
 # -------------------------
-journal_router = Router()
-_journal_until: Dict[int, float] = {}  # user_id -> timestamp_deadline
+class JournalFlow(StatesGroup):
+    waiting_note = State()
 
-@journal_router.message(F.text.in_({"📝 Дневник", "/journal"}))
-async def journal_start(message: Message):
-    _journal_until[message.from_user.id] = time.time() + 300  # 5 минут
+@text_routes.route("📝 Дневник", "/journal")
+async def journal_start(message: Message, state: FSMContext):
+    await state.set_state(JournalFlow.waiting_note)
+    await state.update_data(journal_until=time.time() + 300)  # 5 минут
     await message.answer("Напишите заметку в дневник (1–3 предложения) — у вас 5 минут, потом окно закроется.")
 
-@journal_router.message(F.text)
-async def journal_capture(message: Message):
-    deadline = _journal_until.get(message.from_user.id)
-    if not deadline or time.time() > deadline:
-        return  # не в «окне дневника»
-    async with SessionLocal() as s:
-        user_id = (await s.execute(sqltext("SELECT id FROM users WHERE tg_id=:t"), {"t": str(message.from_user.id)})).scalar_one()
-        s.add(JournalEntry(user_id=user_id, mood=None, text=message.text))
-        await s.commit()
-    _journal_until.pop(message.from_user.id, None)
+@text_routes.fallback(JournalFlow.waiting_note)
+async def journal_capture(message: Message, session: AsyncSession, state: FSMContext):
+    data = await state.get_data()
+    deadline = data.pop("journal_until", 0)
+    await state.set_state(None)
+    await state.set_data(data)
+    if time.time() > deadline:
+        # окно дневника закрылось — это обычное сообщение в диалог
+        return await talk(message)
+    user = await get_user_identity(message.from_user.id, session=session)
+    session.add(JournalEntry(user_id=user.id, mood=None, text=message.text))
     await message.answer("Сохранила запись. Спасибо, что доверяете.")
-    await log_event(str(message.from_user.id), "journal_saved", {"len": len(message.text)})
+    await log_event(message.from_user.id, "journal_saved", {"len": len(message.text)})
 
 # -------------------------
 # 8.6 Шкалы PHQ-9 и GAD-7 (простая сумма баллов)
@@ -1228,10 +2801,9 @@ def _answers_kb(prefix: str, idx: int) -> InlineKeyboardMarkup:
                          for score, txt in enumerate(ANSWER_LABELS)]
     )
 
-# временное хранилище прогресса шкал: user_id -> {"phq":[...], "gad":[...]}
-_scale_progress: Dict[int, Dict[str, List[int]]] = {}
-
-@scales_router.message(text_matches("🧪 Шкалы", "Шкалы", "/tests"))
+# прогресс шкал хранится в данных FSM пользователя: {"phq": [...], "gad": [...]};
+# состояние при этом не выставляется, чтобы свободный текст по-прежнему уходил в диалог
+@text_routes.route("🧪 Шкалы", "Шкалы", "/tests")
 async def tests_menu(message: Message):
     kb = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -1242,22 +2814,28 @@ async def tests_menu(message: Message):
     await message.answer("Выберите шкалу. Это скрининг (предварительная оценка), не диагноз и не замена врачу.", reply_markup=kb)
 
 @scales_router.callback_query(F.data.startswith("phq:"))
-async def phq(cb: CallbackQuery):
+async def phq(cb: CallbackQuery, state: FSMContext):
     idx = int(cb.data.split(":")[1])
+    if idx == 0:
+        await state.update_data(phq=[])
     if idx < len(PHQ9):
         await cb.message.edit_text(f"PHQ-9 — вопрос {idx+1}/9\n\n{PHQ9[idx]}\nКак часто за последние 2 недели?", reply_markup=_answers_kb("phqa", idx))
         await cb.answer()
 
 @scales_router.callback_query(F.data.startswith("gad:"))
-async def gad(cb: CallbackQuery):
+async def gad(cb: CallbackQuery, state: FSMContext):
     idx = int(cb.data.split(":")[1])
+    if idx == 0:
+        await state.update_data(gad=[])
     if idx < len(GAD7):
         await cb.message.edit_text(f"GAD-7 — вопрос {idx+1}/7\n\n{GAD7[idx]}\nКак часто за последние 2 недели?", reply_markup=_answers_kb("gada", idx))
         await cb.answer()
 
-async def _store_and_next(cb: CallbackQuery, scale_key: str, idx: int, score: int):
-    prog = _scale_progress.setdefault(cb.from_user.id, {"phq": [], "gad": []})
-    prog[scale_key].append(score)
+async def _store_and_next(cb: CallbackQuery, session: AsyncSession, state: FSMContext,
+                          scale_key: str, idx: int, score: int):
+    data = await state.get_data()
+    # ответ кладём на место вопроса: повторное нажатие не задвоит балл
+    scores = data.get(scale_key, [])[:idx] + [score]
     next_idx = idx + 1
     total_q = 9 if scale_key == "phq" else 7
     if next_idx < total_q:
@@ -1265,43 +2843,39 @@ async def _store_and_next(cb: CallbackQuery, scale_key: str, idx: int, score: in
             await cb.message.edit_text(f"PHQ-9 — вопрос {next_idx+1}/9\n\n{PHQ9[next_idx]}\nКак часто за последние 2 недели?", reply_markup=_answers_kb("phqa", next_idx))
         else:
             await cb.message.edit_text(f"GAD-7 — вопрос {next_idx+1}/7\n\n{GAD7[next_idx]}\nКак часто за последние 2 недели?", reply_markup=_answers_kb("gada", next_idx))
+        await state.update_data({scale_key: scores})
         await cb.answer()
         return
-    # закончили: сохраним сумму в БД
-    scores = prog[scale_key]
+    # закончили: очистим прогресс и сохраним сумму в БД
+    data.pop(scale_key, None)
+    await state.set_data(data)
     total = sum(scores)
     scale_name = "PHQ9" if scale_key == "phq" else "GAD7"
-    async with SessionLocal() as s:
-        user_id = (await s.execute(sqltext("SELECT id FROM users WHERE tg_id=:t"), {"t": str(cb.from_user.id)})).scalar_one()
-        s.add(ScaleResult(user_id=user_id, scale=scale_name, score=total, answers={"scores": scores}))
-        await s.commit()
-    # очистим прогресс
-    prog[scale_key] = []
+    user = await get_user_identity(cb.from_user.id, session=session)
+    session.add(ScaleResult(user_id=user.id, scale=scale_name, score=total, answers={"scores": scores}))
     await cb.message.edit_text(f"{scale_name} завершена. Ваш суммарный балл: {total}.\nЭто скрининг, не диагноз. "
                                f"Если баллы высоки или есть мысли о самоповреждении — обратитесь за помощью. "
                                f"Я помогу обсудить результат, если хотите.")
-    await log_event(str(cb.from_user.id), "scale_finished", {"scale": scale_name, "score": total})
+    await log_event(cb.from_user.id, "scale_finished", {"scale": scale_name, "score": total})
     await cb.answer("Готово")
 
 @scales_router.callback_query(F.data.startswith("phqa:"))
-async def phq_answer(cb: CallbackQuery):
+async def phq_answer(cb: CallbackQuery, session: AsyncSession, state: FSMContext):
     _, idx, score = cb.data.split(":")
-    await _store_and_next(cb, "phq", int(idx), int(score))
+    await _store_and_next(cb, session, state, "phq", int(idx), int(score))
 
 @scales_router.callback_query(F.data.startswith("gada:"))
-async def gad_answer(cb: CallbackQuery):
+async def gad_answer(cb: CallbackQuery, session: AsyncSession, state: FSMContext):
     _, idx, score = cb.data.split(":")
-    await _store_and_next(cb, "gad", int(idx), int(score))
+    await _store_and_next(cb, session, state, "gad", int(idx), int(score))
 
 # -------------------------
 # 8.7 Ресурсы помощи
 # -------------------------
-resources_router = Router()
-
-@resources_router.message(text_matches("🆘 Ресурсы", "Ресурсы", "/resources"))
+@text_routes.route("🆘 Ресурсы", "Ресурсы", "/resources")
 async def resources(message: Message):
     await message.answer(CRISIS_TEXT, disable_web_page_preview=True)
-    await log_event(str(message.from_user.id), "resources_open", {})
+    await log_event(message.from_user.id, "resources_open", {})
 
 # -------------------------
 # 8.8 Подписка (демо-счета) и рефералка (улучшено)
@@ -1370,31 +2944,23 @@ ACCOUNT_KB = InlineKeyboardMarkup(
     ]
 )
 
-@account_router.message(text_matches("💳 Подписка", "Подписка", "подписка", "/account"))
-async def account(message: Message):
-    # Покажем базовую информацию + активные бонусы
-    async with SessionLocal() as s:
-        bonuses = (await s.execute(
-            select(UserBonus).where(UserBonus.user_tg_id == str(message.from_user.id))
-        )).scalars().all()
-    active_days = sum(b.days for b in bonuses if b.activated)
-    pending_paid = 0  # приглашённые, которые ещё не оплатили
-    # Подсчитаем pending из рефералок (joined, но не paid)
-    async with SessionLocal() as s:
-        joined = (await s.execute(select(Referral).where(
-            Referral.referrer_tg_id == str(message.from_user.id),
-            Referral.status.in_(("joined","clicked"))
-        ))).scalars().all()
-        paid = (await s.execute(select(Referral).where(
-            Referral.referrer_tg_id == str(message.from_user.id),
-            Referral.status == "paid"
-        ))).scalars().all()
-        pending_paid = max(0, len(joined) - len(paid))
+@text_routes.route("💳 Подписка", "Подписка", "/account")
+async def account(message: Message, session: AsyncSession):
+    # Покажем базовую информацию + активные бонусы и остаток суточной квоты
+    user = await get_user_identity(message.from_user.id, message.from_user.username, session=session)
+    limit = daily_request_limit(user.plan)
+    remaining = await quota_meter.remaining(user.id, user.plan)
+    quota_line = "*без ограничений*" if limit is None else f"*{remaining}* из {limit}"
+    counters = await get_referral_counters(message.from_user.id, session=session)
+    active_days = counters.bonus_days
+    # приглашённые, которые ещё не оплатили (joined/clicked за вычетом paid)
+    pending_paid = max(0, counters.joined + counters.clicked - counters.paid)
 
     text = (
         "Ваши планы и бонусы.\n"
         f"Активных бонусных дней: *{active_days}*\n"
-        f"Ожидают бонуса (после оплаты друзей): *{pending_paid}*\n\n"
+        f"Ожидают бонуса (после оплаты друзей): *{pending_paid}*\n"
+        f"Запросов на сегодня: {quota_line}\n\n"
         "Выберите план и изучите подробности ниже ⤵️"
     )
     await message.answer(text, reply_markup=ACCOUNT_KB)
@@ -1402,7 +2968,7 @@ async def account(message: Message):
     await message.answer(build_tariff_faq())
 
 @account_router.callback_query(F.data.startswith("pay:"))
-async def pay(cb: CallbackQuery):
+async def pay(cb: CallbackQuery, session: AsyncSession):
     _, plan_code, period = cb.data.split(":")
     plan = TARIFF_PLANS.get(plan_code)
     if not plan:
@@ -1427,17 +2993,15 @@ async def pay(cb: CallbackQuery):
     )
     await cb.message.answer(message_text)
     await log_event(
-        str(cb.from_user.id),
+        cb.from_user.id,
         "payment_created",
         {"plan": plan_code, "period": period, "price": price},
     )
     # ДЕМО: считаем, что друг «оплатил» → активируем бонус пригласившему (если был)
-    await activate_referral_reward_for_payer(cb.from_user.id)
+    await activate_referral_reward_for_payer(cb.from_user.id, session=session)
     await cb.answer("Ссылка отправлена")
 
-invite_router = Router()
-
-@invite_router.message(F.text.in_({"💌 Пригласить друга", "/invite"}))
+@text_routes.route("💌 Пригласить друга", "/invite")
 async def invite(message: Message):
     code = make_ref_code(message.from_user.id)
     me = await bot.get_me()
@@ -1449,33 +3013,19 @@ async def invite(message: Message):
         f"Ваша ссылка:\n{link}\n\n"
         "Поделитесь ею с другом 💛"
     )
-    await log_event(str(message.from_user.id), "referral_link_shown", {"code": code})
+    await log_event(message.from_user.id, "referral_link_shown", {"code": code})
 
 # Новый раздел со статистикой
-referrals_router = Router()
-
-@referrals_router.message(F.text.in_({"👥 Рефералы", "/referrals"}))
-async def referrals(message: Message):
+@text_routes.route("👥 Рефералы", "/referrals")
+async def referrals(message: Message, session: AsyncSession):
     code = make_ref_code(message.from_user.id)
     me = await bot.get_me()
     link = f"https://t.me/{me.username}?start=ref{code}"
-    async with SessionLocal() as s:
-        total_clicked = (await s.execute(select(func.count()).select_from(
-            select(Referral).where(Referral.referrer_tg_id == str(message.from_user.id),
-                                   Referral.status == "clicked").subquery()
-        ))).scalar_one()
-        total_joined = (await s.execute(select(func.count()).select_from(
-            select(Referral).where(Referral.referrer_tg_id == str(message.from_user.id),
-                                   Referral.status.in_(("joined","paid"))).subquery()
-        ))).scalar_one()
-        total_paid    = (await s.execute(select(func.count()).select_from(
-            select(Referral).where(Referral.referrer_tg_id == str(message.from_user.id),
-                                   Referral.status == "paid").subquery()
-        ))).scalar_one()
-        bonuses = (await s.execute(
-            select(UserBonus).where(UserBonus.user_tg_id == str(message.from_user.id))
-        )).scalars().all()
-    active_days = sum(b.days for b in bonuses if b.activated)
+    counters = await get_referral_counters(message.from_user.id, session=session)
+    total_clicked = counters.clicked
+    total_joined = counters.joined + counters.paid
+    total_paid = counters.paid
+    active_days = counters.bonus_days
     text = (
         f"👥 *Мои рефералы*\n"
         f"Ссылка приглашения:\n{link}\n\n"
@@ -1496,42 +3046,303 @@ def _prettify_title(fname_no_ext: str) -> str:
     # первые буквы слов в верхний регистр
     return " ".join(w.capitalize() for w in base.split())
 
-def list_meditations() -> List[Dict[str, str]]:
-    items: List[Dict[str, str]] = []
-    if os.path.isdir(AUDIO_DIR):
-        for fname in sorted(os.listdir(AUDIO_DIR)):
-            if fname.lower().endswith((".mp3", ".m4a", ".ogg", ".oga", ".wav")):
-                slug = os.path.splitext(fname)[0]
-                items.append({
-                    "slug": slug,
-                    "title": _prettify_title(slug),
-                    "filename": fname,
-                    "path": os.path.join(AUDIO_DIR, fname)
-                })
-    return items
-
-async def get_cached_file_id(key: str) -> Optional[str]:
-    async with SessionLocal() as s:
-        rec = (await s.execute(select(MediaCache).where(MediaCache.key == key))).scalar_one_or_none()
-        return rec.file_id if rec else None
+AUDIO_EXTENSIONS = (".mp3", ".m4a", ".ogg", ".oga", ".wav")
+
+class MeditationCatalog:
+    """Каталог медитаций: slug → запись, собирается из AUDIO_DIR и JSON-манифеста на CDN.
+
+    Обработчики читают только память. Папка пересканируется фоном, когда меняется
+    её mtime, манифест перечитывается с тем же периодом.
+    """
+
+    def __init__(self, audio_dir: str, manifest_url: Optional[str], interval: float) -> None:
+        self.audio_dir = audio_dir
+        self.manifest_url = manifest_url
+        self.interval = interval
+        self.items: List[Dict[str, str]] = []
+        self._by_slug: Dict[str, Dict[str, str]] = {}
+        self._local: List[Dict[str, str]] = []
+        self._remote: List[Dict[str, str]] = []
+        self._dir_mtime: Optional[int] = None
+        self._files: Dict[str, Tuple[int, int, str]] = {}  # путь -> (размер, mtime, хэш содержимого)
+        self._task: Optional[asyncio.Task] = None
+        self.rescans = 0
+        self.manifest_errors = 0
+
+    def get(self, slug: str) -> Optional[Dict[str, str]]:
+        return self._by_slug.get(slug)
+
+    @staticmethod
+    def _file_digest(path: str) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _scan_dir(self) -> bool:
+        try:
+            mtime = os.stat(self.audio_dir).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != self._dir_mtime:
+            self._dir_mtime = mtime
+            names = sorted(f for f in os.listdir(self.audio_dir) if f.lower().endswith(AUDIO_EXTENSIONS)) if mtime else []
+            paths = [os.path.join(self.audio_dir, fname) for fname in names]
+        else:
+            paths = [item["path"] for item in self._local]
+        # перезапись файла не меняет mtime папки, поэтому файлы сверяем по размеру и mtime каждый раз
+        changed = len(paths) != len(self._local)
+        files: Dict[str, Tuple[int, int, str]] = {}
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                changed = True
+                continue
+            known = self._files.get(path)
+            if known and known[:2] == (st.st_size, st.st_mtime_ns):
+                files[path] = known
+            else:
+                files[path] = (st.st_size, st.st_mtime_ns, self._file_digest(path))
+                changed = True
+        if not changed:
+            return False
+        self._files = files
+        items: List[Dict[str, str]] = []
+        for path, (_, _, digest) in files.items():
+            fname = os.path.basename(path)
+            slug = os.path.splitext(fname)[0]
+            item = {
+                "slug": slug,
+                "title": _prettify_title(slug),
+                "filename": fname,
+                "path": path,
+                "key": f"med:{digest}",  # file_id привязан к содержимому: заменённый файл загрузится заново
+            }
+            if AUDIO_BASE_URL:
+                item["url"] = f"{AUDIO_BASE_URL}/{fname}"
+            items.append(item)
+        self._local = items
+        self.rescans += 1
+        return True
 
-async def set_cached_file_id(key: str, file_id: str):
-    async with SessionLocal() as s:
-        rec = (await s.execute(select(MediaCache).where(MediaCache.key == key))).scalar_one_or_none()
-        if rec:
-            rec.file_id = file_id
+    async def _fetch_manifest(self) -> bool:
+        if not self.manifest_url:
+            return False
+        try:
+            async with httpx.AsyncClient(timeout=10.0) as client:
+                response = await client.get(self.manifest_url)
+                response.raise_for_status()
+                raw = response.json()
+        except (httpx.HTTPError, ValueError):
+            self.manifest_errors += 1
+            logger.warning("Не удалось загрузить манифест медитаций %s", self.manifest_url)
+            return False
+        entries = raw.get("items") if isinstance(raw, dict) else raw
+        if not isinstance(entries, list):
+            self.manifest_errors += 1
+            logger.warning("Манифест медитаций %s: ожидался список или {\"items\": [...]}", self.manifest_url)
+            return False
+        items: List[Dict[str, str]] = []
+        for entry in entries:
+            if not isinstance(entry, dict) or not all(
+                isinstance(entry.get(field) or "", str) for field in ("slug", "title", "filename", "url", "hash")
+            ):
+                self.manifest_errors += 1
+                logger.warning("Манифест медитаций %s: пропущена некорректная запись %r", self.manifest_url, entry)
+                continue
+            filename = entry.get("filename") or ""
+            url = entry.get("url") or (f"{AUDIO_BASE_URL}/{filename}" if AUDIO_BASE_URL and filename else None)
+            slug = entry.get("slug") or os.path.splitext(filename)[0]
+            if not slug or not url:
+                continue
+            # без хэша в манифесте ключом служит сам URL: новый файл — новый URL
+            digest = entry.get("hash") or hashlib.blake2b(url.encode("utf-8"), digest_size=16).hexdigest()
+            items.append({
+                "slug": slug,
+                "title": entry.get("title") or _prettify_title(slug),
+                "filename": filename,
+                "url": url,
+                "key": f"med:{digest}",
+            })
+        changed = items != self._remote
+        self._remote = items
+        return changed
+
+    def _rebuild(self) -> None:
+        # локальный файл важнее записи манифеста с тем же slug
+        by_slug: Dict[str, Dict[str, str]] = {item["slug"]: item for item in self._remote}
+        by_slug.update({item["slug"]: item for item in self._local})
+        self._by_slug = by_slug
+        self.items = sorted(by_slug.values(), key=lambda item: item["filename"] or item["slug"])
+
+    async def refresh(self) -> None:
+        local_changed = await asyncio.to_thread(self._scan_dir)
+        remote_changed = await self._fetch_manifest()
+        if local_changed or remote_changed:
+            self._rebuild()
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Обновление каталога медитаций не удалось")
+
+    async def start(self) -> None:
+        try:
+            await self.refresh()
+        except Exception:
+            # каталог не должен мешать запуску бота — следующая попытка через interval
+            logger.exception("Первичная загрузка каталога медитаций не удалась")
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "items": len(self.items),
+            "local": len(self._local),
+            "manifest": len(self._remote),
+            "rescans": self.rescans,
+            "manifest_errors": self.manifest_errors,
+        }
+
+meditation_catalog = MeditationCatalog(AUDIO_DIR, AUDIO_MANIFEST_URL, MEDITATION_RESCAN_INTERVAL)
+
+class MediaFileCache:
+    """Telegram file_id по ключу содержимого: в памяти, с записью в media_cache; загружается из БД при старте.
+
+    Прогрев идёт только в процессе, взявшем блокировку фоновых задач, поэтому промах в памяти
+    перед загрузкой файла проверяется одним запросом к media_cache — так file_id, записанные
+    другими процессами, подхватываются без повторной загрузки.
+    """
+
+    def __init__(self) -> None:
+        self._file_ids: Dict[str, str] = {}
+        self.hits = 0
+        self.misses = 0
+        self.db_hits = 0
+
+    async def load(self) -> None:
+        async with SessionLocal() as s:
+            rows = (await s.execute(select(MediaCache.key, MediaCache.file_id))).all()
+        self._file_ids.update({row.key: row.file_id for row in rows})
+
+    async def fetch(self, key: str, session: Optional[AsyncSession] = None) -> Optional[str]:
+        """Читает file_id из media_cache и запоминает в памяти; None, если файл ещё не загружен."""
+        async with _unit_of_work(session) as s:
+            file_id = (await s.execute(select(MediaCache.file_id).where(MediaCache.key == key))).scalar_one_or_none()
+        if file_id is not None:
+            self._file_ids[key] = file_id
+        return file_id
+
+    async def get(self, key: str, session: Optional[AsyncSession] = None) -> Optional[str]:
+        file_id = self._file_ids.get(key)
+        if file_id is not None:
+            self.hits += 1
+            return file_id
+        file_id = await self.fetch(key, session)
+        if file_id is None:
+            self.misses += 1
         else:
-            s.add(MediaCache(key=key, file_id=file_id))
-        await s.commit()
+            self.db_hits += 1
+        return file_id
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._file_ids
+
+    async def put(self, key: str, file_id: str, session: Optional[AsyncSession] = None) -> None:
+        self._file_ids[key] = file_id
+        async with _unit_of_work(session) as s:
+            rec = (await s.execute(select(MediaCache).where(MediaCache.key == key))).scalar_one_or_none()
+            if rec:
+                rec.file_id = file_id
+            else:
+                s.add(MediaCache(key=key, file_id=file_id))
+
+    def stats(self) -> Dict[str, Any]:
+        return {"file_ids": len(self._file_ids), "hits": self.hits, "db_hits": self.db_hits, "misses": self.misses}
+
+media_files = MediaFileCache()
+
+class MediaPrewarmer:
+    """Фоном загружает аудио каталога в служебный чат и запоминает file_id, чтобы пользователь не ждал загрузки."""
+
+    def __init__(self, chat_id: Optional[int], interval: float) -> None:
+        self.chat_id = chat_id
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self.uploaded = 0
+        self.failed = 0
+
+    async def run_once(self) -> int:
+        uploaded = 0
+        for item in list(meditation_catalog.items):
+            if item["key"] in media_files or await media_files.fetch(item["key"]):
+                continue
+            audio = FSInputFile(item["path"]) if item.get("path") else item["url"]
+            try:
+                sent = await bot.send_audio(self.chat_id, audio=audio, title=item["title"], performer="Aura",
+                                            disable_notification=True)
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                break  # продолжим на следующем проходе
+            except Exception:
+                self.failed += 1
+                logger.exception("Не удалось прогреть медитацию %s", item["slug"])
+                continue
+            if sent.audio and sent.audio.file_id:
+                await media_files.put(item["key"], sent.audio.file_id)
+                uploaded += 1
+            await _delete_quietly(sent)  # file_id остаётся рабочим и после удаления сообщения
+        self.uploaded += uploaded
+        return uploaded
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Прогрев медиа не удался")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self.chat_id and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": bool(self.chat_id), "uploaded": self.uploaded, "failed": self.failed}
+
+media_prewarmer = MediaPrewarmer(MEDIA_PREWARM_CHAT_ID, MEDITATION_RESCAN_INTERVAL)
 
 def _meditation_keyboard(items: List[Dict[str, str]]) -> InlineKeyboardMarkup:
     # Кнопки по одному в строке
     kb = [[InlineKeyboardButton(text=i["title"], callback_data=f"med:{i['slug']}")] for i in items]
     return InlineKeyboardMarkup(inline_keyboard=kb or [[InlineKeyboardButton(text="Папка пуста — что делать?", callback_data="med:help")]])
 
-@meditation_router.message(F.text.in_({"🧘 Медитации", "/meditation"}))
+@text_routes.route("🧘 Медитации", "/meditation")
 async def meditations_menu(message: Message):
-    items = list_meditations()
+    items = meditation_catalog.items
     if not items and not AUDIO_BASE_URL:
         text = (
             "🧘 Медитации: чтобы бот присылал бесплатные аудио,\n"
@@ -1555,31 +3366,29 @@ async def med_help(cb: CallbackQuery):
     await cb.answer()
 
 @meditation_router.callback_query(F.data.startswith("med:"))
-async def med_play(cb: CallbackQuery):
+async def med_play(cb: CallbackQuery, session: AsyncSession):
     slug = cb.data.split(":")[1]
-    items = list_meditations()
-    item = next((i for i in items if i["slug"] == slug), None)
+    item = meditation_catalog.get(slug)
 
-    key = f"med:{slug}"
-    cached = await get_cached_file_id(key)
+    cached = await media_files.get(item["key"], session=session) if item else None
     if cached:
         await cb.message.answer_audio(audio=cached, caption="Приятной практики 🧘", title=item["title"] if item else None, performer="Aura")
         await cb.answer()
-        await log_event(str(cb.from_user.id), "meditation_sent", {"slug": slug, "source": "cache"})
+        await log_event(cb.from_user.id, "meditation_sent", {"slug": slug, "source": "cache"})
         return
 
     try:
-        if item and os.path.isfile(item["path"]):
+        if item and item.get("path"):
             sent = await cb.message.answer_audio(audio=FSInputFile(item["path"]), caption="Приятной практики 🧘", title=item["title"], performer="Aura")
             if sent.audio and sent.audio.file_id:
-                await set_cached_file_id(key, sent.audio.file_id)
-            await log_event(str(cb.from_user.id), "meditation_sent", {"slug": slug, "source": "local"})
-        elif AUDIO_BASE_URL and item:
-            url = f"{AUDIO_BASE_URL}/{item['filename']}"
+                await media_files.put(item["key"], sent.audio.file_id, session=session)
+            await log_event(cb.from_user.id, "meditation_sent", {"slug": slug, "source": "local"})
+        elif item and item.get("url"):
+            url = item["url"]
             sent = await cb.message.answer_audio(audio=url, caption="Приятной практики 🧘", title=item["title"], performer="Aura")
             if sent.audio and sent.audio.file_id:
-                await set_cached_file_id(key, sent.audio.file_id)
-            await log_event(str(cb.from_user.id), "meditation_sent", {"slug": slug, "source": "url"})
+                await media_files.put(item["key"], sent.audio.file_id, session=session)
+            await log_event(cb.from_user.id, "meditation_sent", {"slug": slug, "source": "url"})
         else:
             await cb.message.answer("Не удалось найти аудио. Проверьте папку/URL.")
         await cb.answer()
@@ -1596,30 +3405,322 @@ async def setup_commands():
         await bot.set_my_commands(BOT_COMMANDS, scope=scope)
 
 def register_routers():
-    dp.include_router(start_router)
+    dp.update.outer_middleware(DbSessionMiddleware())
+    text_routes.compile()
+    dp.include_router(text_router)
     dp.include_router(persona_router)
-    dp.include_router(session_router)
     dp.include_router(checkin_router)
-    dp.include_router(journal_router)
     dp.include_router(scales_router)
-    dp.include_router(resources_router)
     dp.include_router(account_router)
-    dp.include_router(invite_router)
-    dp.include_router(referrals_router)
     dp.include_router(meditation_router)
 
 # -------------------------
 # 9) MAIN
 # -------------------------
+_background_jobs_lock: Optional[Any] = None
+
+def acquire_background_jobs() -> bool:
+    """Должен ли этот процесс запускать фоновые задачи-одиночки.
+
+    При webhook с несколькими воркерами и в шардированном режиме on_startup выполняется
+    в каждом процессе; блокировку держит первый из них до своего завершения.
+    """
+    global _background_jobs_lock
+    if BACKGROUND_JOBS in {"on", "1", "true", "yes"}:
+        return True
+    if BACKGROUND_JOBS in {"off", "0", "false", "no"}:
+        return False
+    if _background_jobs_lock is not None:
+        return True
+    try:
+        import fcntl
+    except ImportError:
+        return True  # Windows: несколько процессов бота на хосте не поддерживаются
+    lock_file = open(BACKGROUND_JOBS_LOCK, "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _background_jobs_lock = lock_file
+    return True
+
+async def on_startup():
+    llm_client.start()
+    conversation_writer.start()
+    event_writer.start()
+    background_jobs = acquire_background_jobs()
+    if background_jobs:
+        history_compactor.start()
+    await quota_meter.load_today()
+    await media_files.load()
+    await meditation_catalog.start()
+    if background_jobs:
+        media_prewarmer.start()
+    if isinstance(dp.storage, SqlStorage):
+        await dp.storage.purge_expired()
+    if await referral_counters_missing():
+        logger.warning("Таблица referral_counters пуста: запустите python migrations/referral_counters.py, "
+                       "иначе /referrals и /account покажут только новые рефералы")
+    quota_meter.start()
+
+async def on_shutdown():
+    await history_compactor.stop()
+    await conversation_summaries.stop()
+    await media_prewarmer.stop()
+    await meditation_catalog.stop()
+    # сначала дождёмся фоновых ответов, затем допишем очередь в БД
+    await conversation_bursts.drain()
+    await quota_meter.stop()
+    await conversation_writer.stop()
+    await event_writer.stop()
+    await llm_client.aclose()
+    print(f"LLM-клиент: {llm_client.stats()}")
+    print(f"Очередь LLM: {llm_scheduler.stats()}")
+    print(f"Склейка сообщений: {conversation_bursts.stats()}")
+    print(f"Резюме разговоров: {conversation_summaries.stats()}")
+    print(f"Кэш истории: {history_cache.stats()}")
+    print(f"Кэш пользователей: {identity_cache.stats()}")
+    print(f"Очереди апдейтов: {user_lanes.stats()}")
+    if not _redis:
+        print(f"Антиспам в памяти: {antispam_stats()}")
+    print(f"Компактация истории: {history_compactor.stats()}")
+    print(f"Квоты запросов: {quota_meter.stats()}")
+    print(f"Каталог медитаций: {meditation_catalog.stats()}")
+    print(f"Кэш file_id: {media_files.stats()}, прогрев: {media_prewarmer.stats()}")
+    print(f"Отложенная запись реплик: {conversation_writer.stats()}")
+    print(f"Журнал событий: {event_writer.stats()}")
+
+async def prepare_dispatcher():
+    await init_db()
+    register_routers()
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+
 async def main():
     print("▶ Aura запускается…")
+    await prepare_dispatcher()
+    await setup_commands()
+    # если раньше был выставлен webhook, Telegram не отдаст апдейты через getUpdates
+    await bot.delete_webhook()
+    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+
+# -------------------------
+# 9.1 Webhook-режим (BOT_MODE=webhook)
+# -------------------------
+def _check_webhook_config() -> None:
+    if not WEBHOOK_SECRET:
+        raise SystemExit("❌ Для BOT_MODE=webhook задайте WEBHOOK_SECRET (секрет для заголовка Telegram).")
+    if MULTI_WORKER_WEBHOOK and not (REDIS_URL and FSM_STORAGE in {"redis", "sql"}):
+        raise SystemExit(
+            "❌ WEBHOOK_WORKERS > 1 требует REDIS_URL (антиспам, квоты и состояние FSM общие для всех воркеров). "
+            "Без Redis запускайте один воркер или BOT_MODE=sharded."
+        )
+
+@asynccontextmanager
+async def _webhook_lifespan(app: FastAPI) -> AsyncIterator[None]:
+    _check_webhook_config()
+    await prepare_dispatcher()
+    await setup_commands()
+    if WEBHOOK_BASE_URL:
+        url = WEBHOOK_BASE_URL + WEBHOOK_PATH
+        # каждый воркер проходит lifespan; переустанавливаем webhook, только если он отличается
+        if (await bot.get_webhook_info()).url != url:
+            await bot.set_webhook(url, secret_token=WEBHOOK_SECRET, allowed_updates=dp.resolve_used_update_types())
+    await dp.emit_startup(bot=bot)
+    try:
+        yield
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        await dp.storage.close()
+        await bot.session.close()
+
+webhook_app = FastAPI(title="Aura Telegram Webhook", lifespan=_webhook_lifespan)
+
+async def _feed_update_safely(update: Update) -> None:
+    try:
+        await dp.feed_update(bot, update)
+    except Exception:
+        logger.exception("Ошибка при обработке апдейта %s", update.update_id)
+
+@webhook_app.post(WEBHOOK_PATH)
+async def telegram_webhook(request: Request, background: BackgroundTasks) -> Dict[str, bool]:
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Неверный секрет webhook")
+    update = Update.model_validate(await request.json(), context={"bot": bot})
+    # отвечаем Telegram сразу, обработка идёт после ответа
+    background.add_task(_feed_update_safely, update)
+    return {"ok": True}
+
+def run_webhook() -> None:
+    import uvicorn
+
+    _check_webhook_config()
+    print(f"▶ Aura (webhook) слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}, воркеров: {WEBHOOK_WORKERS}")
+    uvicorn.run("Aura_Psycholog_bot:webhook_app", host=WEBHOOK_HOST, port=WEBHOOK_PORT, workers=WEBHOOK_WORKERS)
+
+# -------------------------
+# 9.2 Шардированный запуск (BOT_MODE=sharded)
+# -------------------------
+def update_user_id(raw: Dict[str, Any]) -> int:
+    """Telegram id автора апдейта по «сырому» JSON, без разбора в модели aiogram."""
+    for value in raw.values():
+        if isinstance(value, dict):
+            sender = value.get("from") or value.get("user") or value.get("chat")
+            if isinstance(sender, dict) and "id" in sender:
+                return int(sender["id"])
+    return int(raw.get("update_id", 0))
+
+def shard_for(user_id: int, shards: int) -> int:
+    return abs(user_id) % shards
+
+class ShardPool:
+    """Процессы-воркеры с очередью на каждого: все апдейты одного пользователя попадают в один процесс.
+
+    Воркеры стартуют через spawn, поэтому target должен быть функцией верхнего уровня модуля.
+    В очередь кладутся пачки «сырых» апдейтов; None — сигнал воркеру завершиться.
+    """
+
+    def __init__(self, workers: int, target: Callable[..., None], queue_size: int, args: Tuple[Any, ...] = ()) -> None:
+        self.workers = max(1, workers)
+        self._ctx = multiprocessing.get_context("spawn")
+        self._queues = [self._ctx.Queue(maxsize=max(1, queue_size)) for _ in range(self.workers)]
+        self._processes = [
+            self._ctx.Process(target=target, args=(index, queue) + args, name=f"aura-shard-{index}", daemon=False)
+            for index, queue in enumerate(self._queues)
+        ]
+        self.dispatched = [0] * self.workers
+
+    def start(self) -> None:
+        for process in self._processes:
+            process.start()
+
+    def submit(self, updates: List[Dict[str, Any]]) -> None:
+        """Раскладывает пачку по воркерам, сохраняя порядок апдейтов каждого пользователя. Блокирует, если очередь полна."""
+        batches: Dict[int, List[Dict[str, Any]]] = {}
+        for raw in updates:
+            batches.setdefault(shard_for(update_user_id(raw), self.workers), []).append(raw)
+        for index, batch in batches.items():
+            self._queues[index].put(batch)
+            self.dispatched[index] += len(batch)
+
+    def stop(self, timeout: float = 30.0) -> None:
+        for queue in self._queues:
+            queue.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"workers": self.workers, "dispatched": list(self.dispatched)}
+
+async def _drain_shard_queue(queue: Any, handle: Callable[[Update], Awaitable[Any]],
+                            max_pending: int = SHARD_MAX_PENDING) -> None:
+    """Читает пачки апдейтов шарда до None и обрабатывает их параллельно, но не больше max_pending сразу.
+
+    Порядок апдейтов одного пользователя держит events_isolation диспетчера (UserLaneIsolation):
+    задачи создаются в порядке апдейтов и встают в полосу пользователя в том же порядке.
+    Пока обрабатываются max_pending апдейтов, воркер не забирает новые из очереди.
+    """
+    loop = asyncio.get_running_loop()
+    pending = asyncio.Semaphore(max(1, max_pending))
+    tasks: Set[asyncio.Task] = set()
+
+    def finished(task: asyncio.Task) -> None:
+        tasks.discard(task)
+        pending.release()
+
+    while True:
+        batch = await loop.run_in_executor(None, queue.get)
+        if batch is None:
+            break
+        for raw in batch:
+            await pending.acquire()
+            task = asyncio.create_task(handle(Update.model_validate(raw, context={"bot": bot})))
+            tasks.add(task)
+            task.add_done_callback(finished)
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+def _shard_worker(index: int, queue: Any) -> None:
+    asyncio.run(_shard_worker_main(index, queue))
+
+async def _shard_worker_main(index: int, queue: Any) -> None:
+    await prepare_dispatcher()
+    await dp.emit_startup(bot=bot)
+    try:
+        await _drain_shard_queue(queue, _feed_update_safely)
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        await dp.storage.close()
+        await bot.session.close()
+
+GET_UPDATES_MAX_BACKOFF = 60.0
+
+def get_updates_retry_delay(body: Dict[str, Any], backoff: float) -> Optional[float]:
+    """Пауза перед повтором неудачного getUpdates; None — повторять бессмысленно (неверный токен)."""
+    if body.get("error_code") == 401:
+        return None
+    retry_after = (body.get("parameters") or {}).get("retry_after")
+    return float(retry_after) if retry_after else backoff
+
+async def run_sharded() -> None:
+    print(f"▶ Aura (sharded) запускается, воркеров: {SHARD_WORKERS}")
+    # схему создаём до старта воркеров, чтобы они не гонялись за create_all
     await init_db()
     register_routers()
     await setup_commands()
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    await bot.delete_webhook()
+    allowed_updates = dp.resolve_used_update_types()
+    pool = ShardPool(SHARD_WORKERS, _shard_worker, SHARD_QUEUE_SIZE)
+    pool.start()
+    loop = asyncio.get_running_loop()
+    offset = 0
+    backoff = 1.0
+    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/getUpdates"
+    try:
+        async with httpx.AsyncClient(timeout=httpx.Timeout(40.0)) as client:
+            while True:
+                try:
+                    response = await client.post(url, json={
+                        "offset": offset, "timeout": 30, "allowed_updates": allowed_updates,
+                    })
+                    body = response.json()
+                    if not isinstance(body, dict):
+                        body = {"ok": False}
+                    body.setdefault("error_code", response.status_code)
+                except (httpx.HTTPError, ValueError) as e:
+                    body = {"ok": False, "error_code": None, "description": repr(e)}
+                if not body.get("ok"):
+                    delay = get_updates_retry_delay(body, backoff)
+                    if delay is None:
+                        logger.error("getUpdates: Telegram отклонил токен (401), остановка")
+                        break
+                    # 409 — параллельный поллер или установлен webhook; 429 — просьба подождать retry_after
+                    logger.warning("getUpdates: %s %s, повтор через %.0f с",
+                                   body.get("error_code"), body.get("description", ""), delay)
+                    await asyncio.sleep(delay)
+                    backoff = min(backoff * 2, GET_UPDATES_MAX_BACKOFF)
+                    continue
+                backoff = 1.0
+                updates = body.get("result") or []
+                if updates:
+                    offset = updates[-1]["update_id"] + 1
+                    await loop.run_in_executor(None, pool.submit, updates)
+    finally:
+        await loop.run_in_executor(None, pool.stop)
+        await bot.session.close()
+        print(f"Шарды: {pool.stats()}")
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if BOT_MODE == "webhook":
+            run_webhook()
+        elif BOT_MODE == "sharded":
+            asyncio.run(run_sharded())
+        else:
+            asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         print("⏹ Остановлено")
@@ -0,0 +1,140 @@
+"""Качество и скорость детектора кризисных фраз.
+
+Прогоняет размеченный корпус `crisis_corpus.jsonl` через прежнюю реализацию
+`detect_risk` (отдельный re.search на каждый шаблон) и через `CrisisDetector`
+из `Aura_Psycholog_bot.py`: печатает precision/recall по меткам, стоимость
+проверки одного сообщения и то, как она растёт при сотнях шаблонов.
+
+Использование:
+    python benchmarks/bench_crisis.py [--number 2000] [--extra-patterns 300] [--errors]
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import re
+import sys
+import timeit
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+# Модуль бота требует токен при импорте; для бенчмарка сеть не нужна.
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:benchmark")
+
+from Aura_Psycholog_bot import CRISIS_PATTERNS, CrisisDetector, crisis_detector  # noqa: E402
+
+CORPUS_PATH = Path(__file__).resolve().parent / "crisis_corpus.jsonl"
+LABELS = list(CRISIS_PATTERNS)
+
+
+def legacy_detect_risk(text: str) -> Optional[str]:
+    """Прежняя реализация `detect_risk` — для сравнения."""
+
+    if not text:
+        return None
+    patterns_suicide = [
+        r"\b(хочу|думаю|планирую)\s+(умереть|сдохнуть|покончить\s+с\s+собой)\b",
+        r"\b(не\s+хочу\s+жить|жить\s+не\s+хочу)\b",
+        r"\b(суицид|самоубийств[оа])\b",
+        r"\b(порезать\s*ся|повесить\s*ся|перерезать\s*вены)\b",
+        r"\b(навредить|вредить)\s+себе\b",
+    ]
+    patterns_violence = [r"\b(убить|навредить)\s+(его|ее|их|человеку|людям)\b"]
+    for p in patterns_suicide:
+        if re.search(p, text, re.IGNORECASE | re.UNICODE):
+            return "suicide"
+    for p in patterns_violence:
+        if re.search(p, text, re.IGNORECASE | re.UNICODE):
+            return "violence"
+    return None
+
+
+def load_corpus() -> List[Tuple[str, Optional[str]]]:
+    with CORPUS_PATH.open(encoding="utf-8") as f:
+        return [(row["text"], row["label"]) for row in map(json.loads, f) if row]
+
+
+def evaluate(detect: Callable[[str], Optional[str]], corpus: List[Tuple[str, Optional[str]]]) -> Dict[str, Any]:
+    """Precision/recall по каждой метке и по факту «кризис/не кризис»."""
+
+    report: Dict[str, Any] = {}
+    predictions = [(detect(text), label) for text, label in corpus]
+    for target in LABELS + ["any"]:
+        def hit(value: Optional[str]) -> bool:
+            return value is not None if target == "any" else value == target
+
+        tp = sum(1 for pred, gold in predictions if hit(pred) and hit(gold))
+        fp = sum(1 for pred, gold in predictions if hit(pred) and not hit(gold))
+        fn = sum(1 for pred, gold in predictions if not hit(pred) and hit(gold))
+        report[target] = (
+            tp / (tp + fp) if tp + fp else 1.0,
+            tp / (tp + fn) if tp + fn else 1.0,
+        )
+    report["errors"] = [(text, pred, gold) for (text, gold), (pred, _) in zip(corpus, predictions) if pred != gold]
+    return report
+
+
+def synthetic_patterns(count: int) -> List[str]:
+    """Шаблоны-заглушки той же формы, что и настоящие, — для оценки роста стоимости."""
+
+    return [rf"\b(хочу|думаю)\s+фраза{i}\s+(себе|ему)\b" for i in range(count)]
+
+
+def _bench(detect: Callable[[str], Optional[str]], texts: List[str], number: int) -> float:
+    """Возвращает среднее время проверки одного сообщения в микросекундах."""
+
+    def run() -> None:
+        for text in texts:
+            detect(text)
+
+    seconds = min(timeit.repeat(run, number=number, repeat=3))
+    return seconds / (number * len(texts)) * 1e6
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=2000, help="сколько раз прогнать весь корпус")
+    parser.add_argument("--extra-patterns", type=int, default=300, help="сколько синтетических шаблонов добавить")
+    parser.add_argument("--errors", action="store_true", help="показать ошибки классификации")
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    texts = [text for text, _ in corpus]
+    print(f"корпус: {len(corpus)} сообщений, {sum(1 for _, l in corpus if l)} кризисных")
+
+    for name, detect in (("прежний detect_risk", legacy_detect_risk), ("CrisisDetector", crisis_detector.detect)):
+        report = evaluate(detect, corpus)
+        metrics = "  ".join(f"{label}: P={p:.2f} R={r:.2f}" for label, (p, r) in
+                            ((k, report[k]) for k in LABELS + ["any"]))
+        print(f"{name:22}{metrics}")
+        if args.errors:
+            for text, pred, gold in report["errors"]:
+                print(f"    {text!r}: {pred} вместо {gold}")
+
+    legacy = _bench(legacy_detect_risk, texts, args.number)
+    current = _bench(crisis_detector.detect, texts, args.number)
+    print(f"прежний detect_risk   : {legacy:7.2f} мкс/сообщение")
+    print(f"CrisisDetector        : {current:7.2f} мкс/сообщение")
+    print(f"ускорение             : {legacy / current:7.2f}×")
+
+    extra = synthetic_patterns(args.extra_patterns)
+    flat = [re.compile(p) for patterns in CRISIS_PATTERNS.values() for p in patterns] + [re.compile(p) for p in extra]
+
+    def loop_detect(text: str) -> Optional[str]:
+        normalized = CrisisDetector.normalize(text)
+        return next(("hit" for p in flat if p.search(normalized)), None)
+
+    grown = CrisisDetector({**CRISIS_PATTERNS, "extra": extra})
+    number = max(1, args.number // 10)
+    print(f"с {len(flat)} шаблонами:")
+    print(f"  re.search по очереди : {_bench(loop_detect, texts, number):7.2f} мкс/сообщение")
+    print(f"  CrisisDetector       : {_bench(grown.detect, texts, number):7.2f} мкс/сообщение")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"""Микробенчмарк очистки персональных данных в payload журнала событий.
+
+Сравнивает прежнюю реализацию `_redact_pii` (json.dumps + два нескомпилированных
+re.sub по всей строке) с `PIIRedactor` из `Aura_Psycholog_bot.py` на наборе
+payload, похожих на реальные события бота.
+
+Использование:
+    python benchmarks/bench_redaction.py [--number 20000]
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import re
+import sys
+import timeit
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+# Модуль бота требует токен при импорте; для бенчмарка сеть не нужна.
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:benchmark")
+
+from Aura_Psycholog_bot import pii_redactor  # noqa: E402
+
+
+def legacy_redact_pii(obj: Optional[dict]) -> Optional[dict]:
+    """Прежняя реализация `_redact_pii` — для сравнения."""
+
+    if not obj:
+        return obj
+    text = json.dumps(obj, ensure_ascii=False)
+    text = re.sub(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}", "[email]", text)
+    text = re.sub(r"(\+?\d[\d\s\-()]{8,}\d)", "[phone]", text)
+    return {"text": text}
+
+
+PAYLOADS: List[Dict[str, Any]] = [
+    {"len": 412},
+    {"source": "start"},
+    {"persona": "mentor_growth"},
+    {"mood": "тревожно"},
+    {"scale": "PHQ9", "score": 14},
+    {"slug": "breath_3min", "source": "cache"},
+    {"plan": "legkoe_dyhanie", "period": "annual", "price": 57240},
+    {"type": "ref_join", "days": 7, "activated": True},
+    {"referrer": "5512345678", "code": "2k1x9s"},
+    {"text": "Мне очень тревожно, не могу уснуть уже третью ночь подряд и всё время думаю о работе"},
+    {"text": "Позвоните мне, пожалуйста: +7 (915) 123-45-67 или напишите на anna.k@example.com"},
+]
+
+
+def _bench(func: Any, number: int) -> float:
+    """Возвращает среднее время обработки одного payload в микросекундах."""
+
+    def run() -> None:
+        for payload in PAYLOADS:
+            func(payload)
+
+    seconds = min(timeit.repeat(run, number=number, repeat=3))
+    return seconds / (number * len(PAYLOADS)) * 1e6
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000, help="сколько раз прогнать весь набор payload")
+    args = parser.parse_args()
+
+    sample = PAYLOADS[-1]
+    print(f"пример: {pii_redactor.redact(sample)}")
+
+    legacy = _bench(legacy_redact_pii, args.number)
+    current = _bench(pii_redactor.redact, args.number)
+    print(f"json.dumps + 2×re.sub : {legacy:7.2f} мкс/payload")
+    print(f"PIIRedactor           : {current:7.2f} мкс/payload")
+    print(f"ускорение             : {legacy / current:7.2f}×")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
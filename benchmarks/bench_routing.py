@@ -0,0 +1,174 @@
+"""Накладные расходы маршрутизации текстовых сообщений.
+
+Собирает два `Dispatcher` с пустыми обработчиками: прежнюю цепочку роутеров
+(`F.text.in_`, `text_matches`, исключающий фильтр у `talk` в `session_router`)
+и одну таблицу `TextRouteTable` из `Aura_Psycholog_bot.py`. Через оба прогоняются
+одни и те же апдейты (`feed_update` + FSM в памяти) и печатается время на апдейт
+по видам текста, а также какой обработчик выбран — прежняя цепочка отдавала
+`/referrals`, `/checkin` и т. п. в диалог.
+
+Использование:
+    python benchmarks/bench_routing.py [--number 3000]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+# Модуль бота требует токен при импорте; для бенчмарка сеть не нужна.
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:benchmark")
+
+from aiogram import Bot, Dispatcher, F, Router  # noqa: E402
+from aiogram.filters import StateFilter  # noqa: E402
+from aiogram.fsm.storage.memory import MemoryStorage  # noqa: E402
+from aiogram.types import Message, Update  # noqa: E402
+
+from Aura_Psycholog_bot import TextRouteTable  # noqa: E402
+
+# (обработчик, фильтр прежней версии, подписи) в порядке прежних роутеров
+LEGACY_ROUTES: List[Tuple[str, str, Tuple[str, ...]]] = [
+    ("cmd_start", "startswith", ("/start",)),
+    ("cmd_menu", "eq", ("/menu",)),
+    ("select_persona", "in", ("🎭 Персонаж", "/persona")),
+    ("session_greet", "in", ("🧠 Сессия", "/session")),
+    ("talk", "talk", ()),
+    ("checkin", "in", ("✅ Чек-ин", "/checkin")),
+    ("journal_start", "in", ("📝 Дневник", "/journal")),
+    ("tests_menu", "matches", ("🧪 Шкалы", "Шкалы", "/tests")),
+    ("resources", "matches", ("🆘 Ресурсы", "Ресурсы", "/resources")),
+    ("account", "matches", ("💳 Подписка", "Подписка", "/account")),
+    ("invite", "in", ("💌 Пригласить друга", "/invite")),
+    ("referrals", "in", ("👥 Рефералы", "/referrals")),
+    ("meditations_menu", "in", ("🧘 Медитации", "/meditation")),
+]
+
+LEGACY_MENU_TEXTS = frozenset({
+    "🧠 Сессия", "🎭 Персонаж", "✅ Чек-ин", "🧪 Шкалы", "Шкалы", "шкалы", "/tests", "📝 Дневник",
+    "🆘 Ресурсы", "Ресурсы", "ресурсы", "/resources", "🧘 Медитации", "💳 Подписка", "Подписка",
+    "подписка", "/account", "💌 Пригласить друга", "👥 Рефералы",
+})
+
+SAMPLES: Dict[str, str] = {
+    "свободный текст": "Мне очень тревожно, не могу уснуть уже третью ночь подряд",
+    "первая кнопка": "🎭 Персонаж",
+    "последняя кнопка": "🧘 Медитации",
+    "команда": "/referrals",
+    "deep-link": "/start ref2k1x9s",
+}
+
+
+def text_matches(*variants: str):
+    normalized = {variant.casefold() for variant in variants}
+
+    def _checker(text: Optional[str]) -> bool:
+        return bool(text) and text.strip().casefold() in normalized
+
+    return F.text.func(_checker)
+
+
+def _recorder(name: str, seen: List[str]):
+    async def handler(message: Message) -> None:
+        seen.append(name)
+
+    return handler
+
+
+def legacy_dispatcher(seen: List[str]) -> Dispatcher:
+    dp = Dispatcher(storage=MemoryStorage())
+    for name, kind, labels in LEGACY_ROUTES:
+        router = Router()
+        if kind == "startswith":
+            flt = (F.text.startswith(labels[0]),)
+        elif kind == "eq":
+            flt = (F.text == labels[0],)
+        elif kind == "in":
+            flt = (F.text.in_(set(labels)),)
+        elif kind == "matches":
+            flt = (text_matches(*labels),)
+        else:
+            flt = (StateFilter(None), F.text & ~F.text.in_(LEGACY_MENU_TEXTS))
+        router.message(*flt)(_recorder(name, seen))
+        dp.include_router(router)
+    return dp
+
+
+def table_dispatcher(seen: List[str]) -> Dispatcher:
+    table = TextRouteTable()
+    for name, kind, labels in LEGACY_ROUTES:
+        if kind == "talk":
+            table.fallback()(_recorder(name, seen))
+        else:
+            table.route(*labels)(_recorder(name, seen))
+    table.compile()
+    router = Router()
+
+    @router.message(F.text)
+    async def route_text(message: Message, **data: Any):
+        return await table.dispatch(message, data)
+
+    dp = Dispatcher(storage=MemoryStorage())
+    dp.include_router(router)
+    return dp
+
+
+def make_update(text: str, update_id: int = 1) -> Update:
+    return Update.model_validate({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 1700000000,
+            "chat": {"id": 42, "type": "private"},
+            "from": {"id": 42, "is_bot": False, "first_name": "user"},
+            "text": text,
+        },
+    })
+
+
+async def _bench(dp: Dispatcher, bot: Bot, update: Update, number: int) -> float:
+    """Возвращает среднее время обработки одного апдейта в микросекундах."""
+
+    best = float("inf")
+    for _ in range(3):
+        started = time.perf_counter()
+        for _ in range(number):
+            await dp.feed_update(bot, update)
+        best = min(best, time.perf_counter() - started)
+    return best / number * 1e6
+
+
+async def run(number: int) -> None:
+    bot = Bot(os.environ["TELEGRAM_BOT_TOKEN"])
+    legacy_seen: List[str] = []
+    table_seen: List[str] = []
+    legacy = legacy_dispatcher(legacy_seen)
+    table = table_dispatcher(table_seen)
+    print(f"{'':18}{'цепочка':>10}{'таблица':>10}   обработчик (цепочка → таблица)")
+    for title, text in SAMPLES.items():
+        update = make_update(text)
+        legacy_seen.clear()
+        table_seen.clear()
+        before = await _bench(legacy, bot, update, number)
+        after = await _bench(table, bot, update, number)
+        routed = f"{legacy_seen[-1]} → {table_seen[-1]}"
+        print(f"{title:18}{before:8.1f}мкс{after:8.1f}мкс   {routed}")
+    await bot.session.close()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=3000, help="сколько раз прогнать каждый апдейт")
+    args = parser.parse_args()
+    asyncio.run(run(args.number))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
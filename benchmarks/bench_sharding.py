@@ -0,0 +1,140 @@
+"""Масштабирование шардированного запуска бота по числу процессов-воркеров.
+
+Гоняет синтетические апдейты через `ShardPool` и цикл воркера `_drain_shard_queue`
+из `Aura_Psycholog_bot.py` — тот же путь, что и `BOT_MODE=sharded`: апдейт идёт в
+`dp.feed_update` диспетчера с `UserLaneIsolation`, только роутер у него один —
+обработчик с CPU-частью типичного сообщения: `detect_risk`, очистка payload от
+персональных данных и сериализация JSON, плюс несколько переключений event loop,
+как у настоящего обработчика. Сеть и БД не участвуют, поэтому видно чистое
+масштабирование по ядрам; порядок завершения апдейтов каждого пользователя
+проверяется.
+
+Использование:
+    python benchmarks/bench_sharding.py [--updates 20000] [--users 500] [--burst 3] [--workers 1,2,4]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+# Модуль бота требует токен при импорте; для бенчмарка сеть не нужна.
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:benchmark")
+
+from Aura_Psycholog_bot import (  # noqa: E402
+    UPDATE_MAX_IN_FLIGHT,
+    ShardPool,
+    UserLaneIsolation,
+    _drain_shard_queue,
+    detect_risk,
+    pii_redactor,
+)
+
+TEXTS = [
+    "Мне очень тревожно, не могу уснуть уже третью ночь подряд и всё время думаю о работе",
+    "Позвоните мне, пожалуйста: +7 (915) 123-45-67 или напишите на anna.k@example.com",
+    "Сегодня было получше, спасибо за вчерашнее упражнение с дыханием",
+    "Не понимаю, зачем всё это, устала от всего",
+]
+
+
+def make_updates(count: int, users: int, burst: int) -> List[Dict[str, Any]]:
+    # пользователь пишет сериями по burst сообщений подряд — они приходят в одной пачке getUpdates
+    return [
+        {
+            "update_id": i,
+            "message": {
+                "message_id": i,
+                "date": 1700000000 + i,
+                "chat": {"id": 10_000 + i // burst % users, "type": "private"},
+                "from": {"id": 10_000 + i // burst % users, "is_bot": False, "first_name": "user"},
+                "text": TEXTS[i % len(TEXTS)],
+            },
+        }
+        for i in range(count)
+    ]
+
+
+def _bench_worker(index: int, queue: Any, results: Any) -> None:
+    from aiogram import Bot, Dispatcher, F, Router
+    from aiogram.fsm.storage.memory import MemoryStorage
+    from aiogram.types import Message
+
+    results.put(("ready", index, 0))
+    processed = 0
+    last_user: Dict[int, int] = {}
+    out_of_order = 0
+
+    router = Router()
+
+    @router.message(F.text)
+    async def handle(message: Message) -> None:
+        nonlocal processed, out_of_order
+        # обработчик несколько раз уступает event loop (запросы к БД, Telegram); ранние апдейты серии — дольше
+        for _ in range(-message.message_id % 3):
+            await asyncio.sleep(0)
+        detect_risk(message.text)
+        json.dumps(pii_redactor.redact({"text": message.text, "len": len(message.text)}), ensure_ascii=False)
+        # шардирование обязано сохранять порядок апдейтов одного пользователя
+        if last_user.get(message.from_user.id, -1) > message.message_id:
+            out_of_order += 1
+        last_user[message.from_user.id] = message.message_id
+        processed += 1
+
+    dp = Dispatcher(storage=MemoryStorage(), events_isolation=UserLaneIsolation(UPDATE_MAX_IN_FLIGHT))
+    dp.include_router(router)
+    bot = Bot("123456:benchmark")
+    asyncio.run(_drain_shard_queue(queue, lambda update: dp.feed_update(bot, update)))
+    results.put(("done", index, processed if not out_of_order else -out_of_order))
+
+
+def run(workers: int, updates: List[Dict[str, Any]], batch: int) -> float:
+    results = multiprocessing.get_context("spawn").Queue()
+    pool = ShardPool(workers, _bench_worker, queue_size=1000, args=(results,))
+    pool.start()
+    for _ in range(workers):
+        results.get()  # все воркеры импортировали модуль и готовы
+    started = time.perf_counter()
+    for i in range(0, len(updates), batch):
+        pool.submit(updates[i:i + batch])
+    pool.stop(timeout=600)
+    elapsed = time.perf_counter() - started
+    done = [results.get()[2] for _ in range(workers)]
+    if any(count < 0 for count in done):
+        raise SystemExit(f"нарушен порядок апдейтов пользователя: {done}")
+    if sum(done) != len(updates):
+        raise SystemExit(f"обработано {sum(done)} из {len(updates)}")
+    return elapsed
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=20000, help="сколько апдейтов прогнать")
+    parser.add_argument("--users", type=int, default=500, help="сколько разных пользователей")
+    parser.add_argument("--workers", default="1,2,4", help="числа воркеров через запятую")
+    parser.add_argument("--batch", type=int, default=100, help="апдейтов в одном getUpdates")
+    parser.add_argument("--burst", type=int, default=3, help="сообщений подряд от одного пользователя")
+    args = parser.parse_args()
+
+    updates = make_updates(args.updates, args.users, args.burst)
+    print(f"ядер CPU: {os.cpu_count()}, апдейтов: {len(updates)}, пользователей: {args.users}")
+    baseline = None
+    for workers in (int(w) for w in args.workers.split(",")):
+        elapsed = run(workers, updates, args.batch)
+        rate = len(updates) / elapsed
+        baseline = baseline or rate
+        print(f"воркеров: {workers:2d}  {rate:9.0f} апдейтов/с  ускорение {rate / baseline:5.2f}×")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
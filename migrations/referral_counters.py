@@ -0,0 +1,92 @@
+"""Пересчёт таблицы `referral_counters` по `referrals` и `user_bonuses`.
+
+Бот обновляет счётчики upsert'ом в той же транзакции, что и запись реферала или
+бонуса, но строк для данных, записанных до появления таблицы, у него нет. Этот
+сценарий один раз при выкладке (и в любой момент для сверки) пересчитывает все
+строки одним агрегирующим запросом. Работает с SQLite и PostgreSQL (берёт
+`DATABASE_URL` так же, как бот) и безопасен на работающем боте: пересчёт идёт
+в одной транзакции, а в PostgreSQL запись в `referrals`, `user_bonuses` и
+`referral_counters` на это время блокируется, поэтому приращения, сделанные
+ботом, не теряются и не учитываются дважды.
+
+Использование:
+    python migrations/referral_counters.py
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import sys
+from pathlib import Path
+
+from sqlalchemy import text
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+from db import engine  # noqa: E402
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS referral_counters (
+    user_tg_id BIGINT NOT NULL PRIMARY KEY,
+    clicked INTEGER NOT NULL DEFAULT 0,
+    joined INTEGER NOT NULL DEFAULT 0,
+    paid INTEGER NOT NULL DEFAULT 0,
+    bonus_days INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+RECOUNT = """
+INSERT INTO referral_counters (user_tg_id, clicked, joined, paid, bonus_days, updated_at)
+SELECT user_tg_id, SUM(clicked), SUM(joined), SUM(paid), SUM(bonus_days), CURRENT_TIMESTAMP
+FROM (
+    SELECT referrer_tg_id AS user_tg_id,
+           SUM(CASE WHEN status = 'clicked' THEN 1 ELSE 0 END) AS clicked,
+           SUM(CASE WHEN status = 'joined' THEN 1 ELSE 0 END) AS joined,
+           SUM(CASE WHEN status = 'paid' THEN 1 ELSE 0 END) AS paid,
+           0 AS bonus_days
+    FROM referrals
+    WHERE status IN ('clicked', 'joined', 'paid')
+    GROUP BY referrer_tg_id
+    UNION ALL
+    SELECT user_tg_id, 0, 0, 0, SUM(days)
+    FROM user_bonuses
+    WHERE activated = :activated
+    GROUP BY user_tg_id
+) AS totals
+GROUP BY user_tg_id
+"""
+
+
+async def run() -> int:
+    print(f"База: {engine.url.render_as_string(hide_password=True)}")
+    dialect = engine.dialect.name
+    if dialect not in {"sqlite", "postgresql"}:
+        print(f"Диалект {dialect} не поддерживается")
+        return 1
+    try:
+        async with engine.begin() as conn:
+            await conn.execute(text(CREATE_TABLE))
+            if dialect == "postgresql":
+                await conn.execute(text(
+                    "LOCK TABLE referrals, user_bonuses, referral_counters IN SHARE ROW EXCLUSIVE MODE"
+                ))
+            # в SQLite DELETE сразу берёт блокировку записи, до конца транзакции бот ждёт
+            await conn.execute(text("DELETE FROM referral_counters"))
+            await conn.execute(text(RECOUNT), {"activated": True})
+            rows = (await conn.execute(text("SELECT COUNT(*) FROM referral_counters"))).scalar_one()
+        print(f"  referral_counters: {rows} строк")
+    finally:
+        await engine.dispose()
+    return 0
+
+
+def main() -> int:
+    argparse.ArgumentParser(description=__doc__.splitlines()[0]).parse_args()
+    return asyncio.run(run())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
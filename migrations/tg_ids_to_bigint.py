@@ -0,0 +1,276 @@
+"""Перевод Telegram ID в основной схеме бота со String на BigInteger.
+
+Затрагивает `users.tg_id`, `event_logs.user_tg_id`, `referrals.referrer_tg_id`,
+`referrals.referred_tg_id` и `user_bonuses.user_tg_id`. Работает с SQLite и
+PostgreSQL (берёт `DATABASE_URL` так же, как бот).
+
+Миграция идёт в две фазы:
+
+1. `backfill` — можно запускать на работающем боте. Для каждой колонки
+   добавляется теневая колонка `<имя>_bigint`, которая заполняется пачками по
+   первичному ключу; каждая пачка — отдельная короткая транзакция, поэтому
+   таблицы не блокируются надолго. Фазу можно прерывать и перезапускать.
+2. `swap` — короткое окно при выкладке новой версии бота (старая версия пишет
+   строки и должна быть остановлена). В одной транзакции на таблицу
+   дозаполняются строки, появившиеся после backfill, старая колонка с индексом
+   удаляется, теневая переименовывается и индексируется заново. Перед первой
+   таблицей `swap` проверяет все колонки: если хоть одно значение не
+   переводится в число, он печатает такие строки и ничего не меняет — их
+   нужно исправить или удалить вручную и запустить `swap` снова.
+
+В PostgreSQL обязательные колонки после `swap` снова `NOT NULL`. SQLite не
+умеет добавлять ограничение к существующей колонке без пересборки таблицы,
+поэтому там колонки остаются без `NOT NULL`; NULL в них не попадёт, потому что
+`swap` не идёт дальше при непереводимых значениях, а модели бота объявляют эти
+колонки обязательными.
+
+Использование:
+    python migrations/tg_ids_to_bigint.py [backfill|swap|all] [--batch 5000] [--pause 0.05]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import sqlite3
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, List, Optional, Tuple
+
+from sqlalchemy import inspect, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+# сколько непереводимых строк печатать, остальные только считаются
+REPORT_LIMIT = 50
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+from db import engine  # noqa: E402
+
+
+@dataclass(frozen=True)
+class Target:
+    table: str
+    column: str
+    unique: bool = False
+    nullable: bool = False
+
+    @property
+    def shadow(self) -> str:
+        return f"{self.column}_bigint"
+
+    @property
+    def index(self) -> str:
+        # имя совпадает с тем, что создаёт SQLAlchemy для index=True
+        return f"ix_{self.table}_{self.column}"
+
+
+TARGETS: List[Target] = [
+    Target("users", "tg_id", unique=True),
+    Target("event_logs", "user_tg_id"),
+    Target("referrals", "referrer_tg_id"),
+    Target("referrals", "referred_tg_id", nullable=True),
+    Target("user_bonuses", "user_tg_id"),
+]
+
+
+async def _columns(conn: AsyncConnection, table: str) -> dict:
+    def load(sync_conn):
+        insp = inspect(sync_conn)
+        if not insp.has_table(table):
+            return {}
+        return {c["name"]: c["type"] for c in insp.get_columns(table)}
+
+    return await conn.run_sync(load)
+
+
+def _is_integer(column_type) -> bool:
+    return column_type.__class__.__name__.upper() in {"BIGINT", "INTEGER", "BIGINTEGER"}
+
+
+async def _state(target: Target) -> str:
+    """`done` — колонка уже целочисленная, `missing` — таблицы нет, иначе `pending`."""
+    async with engine.connect() as conn:
+        columns = await _columns(conn, target.table)
+    if not columns or target.column not in columns:
+        return "missing"
+    if _is_integer(columns[target.column]) and target.shadow not in columns:
+        return "done"
+    return "pending"
+
+
+async def _ensure_shadow(target: Target) -> None:
+    async with engine.begin() as conn:
+        columns = await _columns(conn, target.table)
+        if target.shadow not in columns:
+            await conn.execute(text(f"ALTER TABLE {target.table} ADD COLUMN {target.shadow} BIGINT"))
+
+
+def _convert(value: Optional[str]) -> Optional[int]:
+    if value is None:
+        return None
+    try:
+        return int(str(value).strip())
+    except ValueError:
+        return None
+
+
+Invalid = List[Tuple[int, Any]]
+
+
+async def _fill_batch(conn: AsyncConnection, target: Target, last_id: int, batch: int) -> Tuple[int, int, Invalid]:
+    """Заполняет одну пачку; возвращает (последний id, обновлено строк, [(id, значение)] нечисловых)."""
+    rows = (await conn.execute(
+        text(
+            f"SELECT id, {target.column} FROM {target.table} "
+            f"WHERE id > :last_id AND {target.shadow} IS NULL AND {target.column} IS NOT NULL "
+            f"ORDER BY id LIMIT :batch"
+        ),
+        {"last_id": last_id, "batch": batch},
+    )).all()
+    if not rows:
+        return last_id, 0, []
+    updates = []
+    invalid: Invalid = []
+    for row_id, value in rows:
+        converted = _convert(value)
+        if converted is None:
+            invalid.append((row_id, value))
+            continue
+        updates.append({"id": row_id, "value": converted})
+    if updates:
+        await conn.execute(
+            text(f"UPDATE {target.table} SET {target.shadow} = :value WHERE id = :id"),
+            updates,
+        )
+    return rows[-1][0], len(updates), invalid
+
+
+async def _find_invalid(target: Target, batch: int) -> Invalid:
+    """Строки, чьё значение не переводится в число; только чтение, пачками по id."""
+    async with engine.connect() as conn:
+        columns = await _columns(conn, target.table)
+        pending = f" AND {target.shadow} IS NULL" if target.shadow in columns else ""
+        invalid: Invalid = []
+        last_id = 0
+        while True:
+            rows = (await conn.execute(
+                text(
+                    f"SELECT id, {target.column} FROM {target.table} "
+                    f"WHERE id > :last_id AND {target.column} IS NOT NULL{pending} "
+                    f"ORDER BY id LIMIT :batch"
+                ),
+                {"last_id": last_id, "batch": batch},
+            )).all()
+            if not rows:
+                return invalid
+            invalid.extend((row_id, value) for row_id, value in rows if _convert(value) is None)
+            last_id = rows[-1][0]
+
+
+def _report(target: Target, invalid: Invalid) -> None:
+    print(f"  {target.table}.{target.column}: нечисловых значений {len(invalid)}")
+    for row_id, value in invalid[:REPORT_LIMIT]:
+        print(f"    id={row_id}: {value!r}")
+    if len(invalid) > REPORT_LIMIT:
+        print(f"    … и ещё {len(invalid) - REPORT_LIMIT}")
+
+
+async def backfill(target: Target, batch: int, pause: float) -> None:
+    await _ensure_shadow(target)
+    last_id, total = 0, 0
+    invalid: Invalid = []
+    while True:
+        async with engine.begin() as conn:
+            next_id, updated, bad = await _fill_batch(conn, target, last_id, batch)
+        if next_id == last_id:
+            break
+        last_id = next_id
+        total += updated
+        invalid.extend(bad)
+        if pause:
+            await asyncio.sleep(pause)
+    print(f"  {target.table}.{target.column}: заполнено {total}")
+    if invalid:
+        _report(target, invalid)
+        print("    swap не начнётся, пока эти строки не исправлены или не удалены")
+
+
+async def swap(target: Target, batch: int) -> None:
+    dialect = engine.dialect.name
+    if dialect == "sqlite" and sqlite3.sqlite_version_info < (3, 35, 0):
+        raise RuntimeError(f"SQLite {sqlite3.sqlite_version} не умеет DROP COLUMN, нужна версия 3.35+")
+    await _ensure_shadow(target)
+    async with engine.begin() as conn:
+        if dialect == "postgresql":
+            # блокируем запись в таблицу на время дозаполнения и переименования
+            await conn.execute(text(f"LOCK TABLE {target.table} IN SHARE ROW EXCLUSIVE MODE"))
+        last_id = 0
+        invalid: Invalid = []
+        while True:
+            next_id, _, bad = await _fill_batch(conn, target, last_id, batch)
+            if next_id == last_id:
+                break
+            last_id = next_id
+            invalid.extend(bad)
+        if invalid:
+            # строки появились после проверки в run(); транзакция откатится, таблица не тронута
+            _report(target, invalid)
+            raise RuntimeError(f"{target.table}.{target.column}: есть нечисловые значения, swap прерван")
+        await conn.execute(text(f"DROP INDEX IF EXISTS {target.index}"))
+        await conn.execute(text(f"ALTER TABLE {target.table} DROP COLUMN {target.column}"))
+        await conn.execute(text(f"ALTER TABLE {target.table} RENAME COLUMN {target.shadow} TO {target.column}"))
+        if dialect == "postgresql" and not target.nullable:
+            await conn.execute(text(f"ALTER TABLE {target.table} ALTER COLUMN {target.column} SET NOT NULL"))
+        unique = "UNIQUE " if target.unique else ""
+        await conn.execute(text(f"CREATE {unique}INDEX {target.index} ON {target.table} ({target.column})"))
+    print(f"  {target.table}.{target.column}: BIGINT")
+
+
+async def run(phase: str, batch: int, pause: float) -> int:
+    print(f"База: {engine.url.render_as_string(hide_password=True)}")
+    if engine.dialect.name not in {"sqlite", "postgresql"}:
+        print(f"Диалект {engine.dialect.name} не поддерживается")
+        return 1
+    try:
+        pending: List[Target] = []
+        for target in TARGETS:
+            state = await _state(target)
+            if state != "pending":
+                print(f"  {target.table}.{target.column}: {'уже BIGINT' if state == 'done' else 'нет таблицы'}")
+                continue
+            pending.append(target)
+        if phase in {"backfill", "all"}:
+            for target in pending:
+                await backfill(target, batch, pause)
+        if phase in {"swap", "all"}:
+            # проверяем все колонки до первого swap, чтобы не остановиться на полпути
+            blocked = False
+            for target in pending:
+                invalid = await _find_invalid(target, batch)
+                if invalid:
+                    _report(target, invalid)
+                    blocked = True
+            if blocked:
+                print("swap не выполнен: исправьте или удалите эти строки и запустите снова")
+                return 1
+            for target in pending:
+                await swap(target, batch)
+    finally:
+        await engine.dispose()
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("phase", nargs="?", default="all", choices=["backfill", "swap", "all"])
+    parser.add_argument("--batch", type=int, default=5000, help="строк в одной транзакции backfill")
+    parser.add_argument("--pause", type=float, default=0.05, help="пауза между пачками, секунды")
+    args = parser.parse_args()
+    return asyncio.run(run(args.phase, args.batch, args.pause))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
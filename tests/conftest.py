@@ -0,0 +1,28 @@
+"""Общая настройка тестов: модуль бота импортируется с временной SQLite-базой и без сети."""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+_DB_DIR = tempfile.mkdtemp(prefix="aura-tests-")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{_DB_DIR}/aura.db"
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:tests")
+os.environ.pop("REDIS_URL", None)
+os.environ.pop("DEEPSEEK_API_KEY", None)
+
+import Aura_Psycholog_bot as bot_module  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def aura():
+    asyncio.run(bot_module.init_db())
+    return bot_module
@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("lupa")  # Lua-скрипты в fakeredis
+fakeredis = pytest.importorskip("fakeredis")
+
+
+@pytest.fixture
+def redis_antispam(aura, monkeypatch):
+    fake = fakeredis.FakeAsyncRedis()
+    monkeypatch.setattr(aura, "_redis", fake)
+    monkeypatch.setattr(aura, "_antispam_script", fake.register_script(aura.ANTISPAM_LUA))
+    return fake
+
+
+def test_allow_then_duplicate(aura, redis_antispam):
+    async def scenario():
+        first = await aura.antispam_check(1, "привет", max_per_minute=10, ttl_sec=30)
+        again = await aura.antispam_check(1, "привет", max_per_minute=10, ttl_sec=30)
+        other_user = await aura.antispam_check(2, "привет", max_per_minute=10, ttl_sec=30)
+        return first, again, other_user
+
+    assert asyncio.run(scenario()) == (None, aura.ANTISPAM_DUPLICATE, None)
+
+
+def test_flood_is_rate_limited(aura, redis_antispam):
+    async def scenario():
+        return [await aura.antispam_check(3, f"сообщение {i}", max_per_minute=3) for i in range(5)]
+
+    verdicts = asyncio.run(scenario())
+    assert verdicts == [None, None, None, aura.ANTISPAM_RATE_LIMITED, aura.ANTISPAM_RATE_LIMITED]
+
+
+def test_duplicate_expires_after_ttl(aura, redis_antispam):
+    async def scenario():
+        assert await aura.antispam_check(4, "снова", ttl_sec=1) is None
+        assert await aura.antispam_check(4, "снова", ttl_sec=1) == aura.ANTISPAM_DUPLICATE
+        await asyncio.sleep(1.2)
+        return await aura.antispam_check(4, "снова", ttl_sec=1)
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_rate_window_slides(aura, redis_antispam):
+    script = aura._antispam_script
+    now = int(time.time() * 1000)
+
+    async def call(at_ms: int, member: str) -> int:
+        return int(await script(keys=["rate:5"], args=[at_ms, 60_000, 2, member, 0]))
+
+    async def scenario():
+        return [
+            await call(now, "a"),
+            await call(now + 1, "b"),
+            await call(now + 2, "c"),  # третий за минуту — отказ
+            await call(now + 60_001, "d"),  # первые два вышли из окна
+        ]
+
+    assert asyncio.run(scenario()) == [0, 0, 1, 0]
@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+import subprocess
+import sys
+
+import pytest
+
+fcntl = pytest.importorskip("fcntl")
+
+
+def test_only_lock_holder_runs_background_jobs(aura, tmp_path, monkeypatch):
+    lock_path = tmp_path / "jobs.lock"
+    monkeypatch.setattr(aura, "BACKGROUND_JOBS", "auto")
+    monkeypatch.setattr(aura, "BACKGROUND_JOBS_LOCK", str(lock_path))
+    monkeypatch.setattr(aura, "_background_jobs_lock", None)
+
+    # блокировку держит другой процесс — этот задачи не запускает
+    holder = subprocess.Popen(
+        [sys.executable, "-c",
+         "import fcntl, sys, time; f = open(sys.argv[1], 'a'); fcntl.flock(f, fcntl.LOCK_EX); "
+         "print('locked', flush=True); time.sleep(30)", str(lock_path)],
+        stdout=subprocess.PIPE, text=True,
+    )
+    try:
+        assert holder.stdout.readline().strip() == "locked"
+        assert aura.acquire_background_jobs() is False
+    finally:
+        holder.kill()
+        holder.wait()
+
+    assert aura.acquire_background_jobs() is True
+    assert aura.acquire_background_jobs() is True  # повторный вызов в том же процессе
+    aura._background_jobs_lock.close()
+
+
+def test_background_jobs_can_be_forced(aura, monkeypatch):
+    monkeypatch.setattr(aura, "BACKGROUND_JOBS", "off")
+    assert aura.acquire_background_jobs() is False
+    monkeypatch.setattr(aura, "BACKGROUND_JOBS", "on")
+    assert aura.acquire_background_jobs() is True
@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
+from aiogram.fsm.storage.base import StorageKey
+from sqlalchemy import select
+
+
+def _key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+async def _rows(aura, storage, key):
+    async with aura.SessionLocal() as s:
+        return (await s.execute(
+            select(aura.FsmRecord).where(aura.FsmRecord.key == storage.key_builder.build(key))
+        )).scalars().all()
+
+
+def test_clearing_unknown_key_is_a_noop(aura):
+    storage = aura.SqlStorage(ttl=60)
+    key = _key(101)
+
+    async def scenario():
+        await storage.set_state(key, None)
+        await storage.set_data(key, {})
+        assert await storage.get_state(key) is None
+        assert await storage.get_data(key) == {}
+        assert await _rows(aura, storage, key) == []
+
+    asyncio.run(scenario())
+
+
+def test_clearing_expired_key_deletes_row(aura):
+    storage = aura.SqlStorage(ttl=60)
+    key = _key(102)
+
+    async def scenario():
+        await storage.set_data(key, {"scale": "PHQ9", "idx": 3})
+        async with aura.session_scope() as s:
+            record = await s.get(aura.FsmRecord, storage.key_builder.build(key))
+            record.expires_at = time.time() - 1
+        assert await storage.get_data(key) == {}
+        await storage.set_data(key, {})
+        assert await _rows(aura, storage, key) == []
+
+    asyncio.run(scenario())
+
+
+def test_state_and_data_round_trip(aura):
+    storage = aura.SqlStorage(ttl=60)
+    key = _key(103)
+
+    async def scenario():
+        await storage.set_state(key, aura.JournalFlow.waiting_note)
+        await storage.set_data(key, {"journal_until": 1.5})
+        assert await storage.get_state(key) == aura.JournalFlow.waiting_note.state
+        assert await storage.get_data(key) == {"journal_until": 1.5}
+        await storage.set_state(key, None)
+        await storage.set_data(key, {})
+        assert await _rows(aura, storage, key) == []
+
+    asyncio.run(scenario())
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import asyncio
+from typing import List
+
+import pytest
+from sqlalchemy import select
+
+
+@pytest.fixture
+def summaries(aura, monkeypatch):
+    replies: List[str] = []
+
+    async def fake_reply(messages, **kwargs):
+        return replies.pop(0) if replies else "резюме"
+
+    summarizer = aura.ConversationSummarizer(batch_size=500)
+    monkeypatch.setattr(aura, "DEEPSEEK_API_KEY", "test-key")
+    monkeypatch.setattr(aura, "deepseek_reply", fake_reply)
+    monkeypatch.setattr(aura, "conversation_summaries", summarizer)
+    summarizer.replies = replies
+    return summarizer
+
+
+async def _user_with_turns(aura, tg_id: int, count: int) -> int:
+    identity = await aura.get_user_identity(tg_id, "u")
+    async with aura.session_scope() as s:
+        s.add_all(aura.ConversationMessage(user_id=identity.id, role="user" if i % 2 == 0 else "assistant",
+                                           content=f"реплика {i}") for i in range(count))
+    return identity.id
+
+
+async def _compact(aura, summarizer) -> None:
+    await aura.HistoryCompactor(interval=60).run_once()
+    while summarizer._tasks:
+        await asyncio.gather(*summarizer._tasks.values())
+
+
+async def _state(aura, user_id: int):
+    async with aura.session_scope() as s:
+        contents = (await s.execute(
+            select(aura.ConversationMessage.content)
+            .where(aura.ConversationMessage.user_id == user_id)
+            .order_by(aura.ConversationMessage.id)
+        )).scalars().all()
+        summary = (await s.execute(
+            select(aura.ConversationSummary).where(aura.ConversationSummary.user_id == user_id)
+        )).scalar_one_or_none()
+    return contents, summary
+
+
+def test_stale_turns_are_deleted_only_after_folding(aura, summaries):
+    limit = aura.CONVERSATION_HISTORY_LIMIT
+
+    async def scenario():
+        user_id = await _user_with_turns(aura, 8_000_001, limit + 5)
+        await _compact(aura, summaries)
+        return await _state(aura, user_id)
+
+    contents, summary = asyncio.run(scenario())
+    assert contents == [f"реплика {i}" for i in range(5, limit + 5)]
+    assert summary.summary == "резюме" and summary.turns_folded == 5
+    assert summaries.turns_folded == 5
+
+
+def test_failed_fold_keeps_turns_for_the_next_pass(aura, summaries):
+    limit = aura.CONVERSATION_HISTORY_LIMIT
+
+    async def scenario():
+        user_id = await _user_with_turns(aura, 8_000_002, limit + 3)
+        summaries.replies.append(aura.LLM_FALLBACK_REPLY)
+        await _compact(aura, summaries)
+        after_failure = await _state(aura, user_id)
+        await _compact(aura, summaries)
+        return after_failure, await _state(aura, user_id)
+
+    (kept, no_summary), (contents, summary) = asyncio.run(scenario())
+    assert len(kept) == limit + 3 and no_summary is None
+    assert summaries.stats()["postponed"] == 1
+    assert len(contents) == limit and summary.turns_folded == 3
+
+
+def test_turns_are_kept_without_llm_key(aura, summaries, monkeypatch):
+    monkeypatch.setattr(aura, "DEEPSEEK_API_KEY", "")
+    limit = aura.CONVERSATION_HISTORY_LIMIT
+
+    async def scenario():
+        user_id = await _user_with_turns(aura, 8_000_003, limit + 4)
+        await _compact(aura, summaries)
+        return await _state(aura, user_id)
+
+    contents, summary = asyncio.run(scenario())
+    assert len(contents) == limit + 4 and summary is None
+
+
+def test_stop_interrupts_a_fold_without_losing_turns(aura, summaries, monkeypatch):
+    limit = aura.CONVERSATION_HISTORY_LIMIT
+    started = asyncio.Event()
+
+    async def slow_reply(messages, **kwargs):
+        started.set()
+        await asyncio.sleep(60)
+        return "резюме"
+
+    monkeypatch.setattr(aura, "deepseek_reply", slow_reply)
+
+    async def scenario():
+        user_id = await _user_with_turns(aura, 8_000_004, limit + 2)
+        await aura.HistoryCompactor(interval=60).run_once()
+        await started.wait()
+        await summaries.stop()
+        return summaries.stats()["running"], await _state(aura, user_id)
+
+    running, (contents, summary) = asyncio.run(scenario())
+    assert running == 0
+    assert len(contents) == limit + 2 and summary is None
@@ -0,0 +1,36 @@
+from __future__ import annotations
+
+import asyncio
+
+from sqlalchemy import select
+
+
+def test_persona_change_is_visible_after_commit(aura, monkeypatch):
+    cache = aura.UserIdentityCache(max_size=100, ttl=600)
+    monkeypatch.setattr(aura, "identity_cache", cache)
+    tg_id = 7_000_001
+
+    async def scenario():
+        await aura.get_user_identity(tg_id, "u")  # создаёт пользователя, персона по умолчанию
+        async with aura.session_scope() as session:
+            user = (await session.execute(select(aura.User).where(aura.User.tg_id == tg_id))).scalar_one()
+            user.persona = "coach"
+            cache.invalidate_after_commit(session, tg_id)
+            await session.flush()
+            # апдейт ещё не закоммичен: параллельное чтение видит старую персону и кэширует её
+            stale = await aura.get_user_identity(tg_id, "u")
+        fresh = await aura.get_user_identity(tg_id, "u")
+        return stale.persona, fresh.persona
+
+    assert asyncio.run(scenario()) == ("pro_psychologist", "coach")
+
+
+def test_read_started_before_invalidation_is_not_cached(aura):
+    cache = aura.UserIdentityCache(max_size=100, ttl=600)
+    identity = aura.UserIdentity(id=1, persona="pro_psychologist", plan=aura.FREE_PLAN, username="u")
+    epoch = cache.epoch
+    cache.invalidate(1)
+    cache.put(1, identity, epoch)
+    assert cache.get(1) is None
+    cache.put(1, identity, cache.epoch)
+    assert cache.get(1) is identity
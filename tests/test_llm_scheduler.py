@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+import asyncio
+from typing import List
+
+
+def test_free_plan_ranks_after_tariffs(aura):
+    ranks = [aura.plan_priority(code) for code in reversed(aura.TARIFF_PLAN_ORDER)]
+    assert ranks == sorted(ranks)
+    assert aura.plan_priority(aura.FREE_PLAN) > ranks[-1]
+    assert aura.plan_priority(None) == aura.plan_priority("unknown") == aura.plan_priority(aura.FREE_PLAN)
+    assert aura.BACKGROUND_PRIORITY > aura.plan_priority(aura.FREE_PLAN)
+
+
+def test_higher_tier_is_admitted_first(aura):
+    scheduler = aura.LLMScheduler(max_concurrency=1, max_queue=10)
+    admitted: List[str] = []
+
+    async def request(plan: str) -> None:
+        async with scheduler.slot(aura.plan_priority(plan), deadline=5):
+            admitted.append(plan)
+            await asyncio.sleep(0)
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def occupy() -> None:
+            async with scheduler.slot(0, deadline=5):
+                await release.wait()
+
+        holder = asyncio.create_task(occupy())
+        await asyncio.sleep(0)
+        # в очередь встают в порядке от младшего плана к старшему
+        waiters = [asyncio.create_task(request(plan)) for plan in [aura.FREE_PLAN, *aura.TARIFF_PLAN_ORDER]]
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == len(waiters)
+        release.set()
+        await asyncio.gather(holder, *waiters)
+
+    asyncio.run(scenario())
+    assert admitted == [*reversed(aura.TARIFF_PLAN_ORDER), aura.FREE_PLAN]
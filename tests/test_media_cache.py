@@ -0,0 +1,19 @@
+from __future__ import annotations
+
+import asyncio
+
+
+def test_miss_falls_back_to_media_cache_once(aura):
+    async def scenario():
+        async with aura.session_scope() as s:
+            s.add(aura.MediaCache(key="med:other-process", file_id="AgAD-from-prewarmer"))
+        cache = aura.MediaFileCache()  # этот процесс не прогревал и загрузил кэш до записи
+        first = await cache.get("med:other-process")
+        second = await cache.get("med:other-process")
+        missing = await cache.get("med:not-uploaded")
+        return first, second, missing, cache.stats()
+
+    first, second, missing, stats = asyncio.run(scenario())
+    assert first == second == "AgAD-from-prewarmer"
+    assert missing is None
+    assert stats == {"file_ids": 1, "hits": 1, "db_hits": 1, "misses": 1}
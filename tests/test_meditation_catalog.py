@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+
+import httpx
+import pytest
+
+
+@pytest.fixture
+def serve_manifest(aura, monkeypatch):
+    def install(payload):
+        transport = httpx.MockTransport(lambda request: httpx.Response(200, json=payload))
+        monkeypatch.setattr(aura.httpx, "AsyncClient", functools.partial(httpx.AsyncClient, transport=transport))
+
+    return install
+
+
+def _catalog(aura, tmp_path):
+    return aura.MeditationCatalog(str(tmp_path), "https://cdn.example.com/index.json", interval=3600)
+
+
+def test_manifest_skips_malformed_entries(aura, tmp_path, serve_manifest):
+    serve_manifest({"items": [
+        "sleep.mp3",
+        {"slug": "calm", "title": "Спокойствие", "url": "https://cdn.example.com/calm.mp3"},
+        {"slug": ["not", "a", "string"], "url": "https://cdn.example.com/x.mp3"},
+        42,
+    ]})
+    catalog = _catalog(aura, tmp_path)
+
+    asyncio.run(catalog.refresh())
+
+    assert [item["slug"] for item in catalog.items] == ["calm"]
+    assert catalog.manifest_errors == 3
+
+
+@pytest.mark.parametrize("payload", [["sleep.mp3", "calm.mp3"], {"items": "sleep.mp3"}, "index"])
+def test_bad_manifest_shape_does_not_abort_start(aura, tmp_path, serve_manifest, payload):
+    serve_manifest(payload)
+    catalog = _catalog(aura, tmp_path)
+
+    async def scenario():
+        await catalog.start()
+        await catalog.stop()
+
+    asyncio.run(scenario())
+    assert catalog.items == []
+    assert catalog.manifest_errors >= 1
+
+
+def test_manifest_is_not_polled_without_url(aura, tmp_path):
+    catalog = aura.MeditationCatalog(str(tmp_path), None, interval=3600)
+    asyncio.run(catalog.refresh())
+    assert catalog.stats()["manifest_errors"] == 0
@@ -0,0 +1,15 @@
+from __future__ import annotations
+
+
+def test_telegram_ids_are_masked(aura):
+    payload = {"referrer": "5512345678", "from": "5512345678", "code": "2k1x9s", "days": 7}
+    assert aura.pii_redactor.redact(payload) == {
+        "referrer": "[phone]", "from": "[phone]", "code": "2k1x9s", "days": 7,
+    }
+
+
+def test_nested_leaves_are_masked(aura):
+    payload = {"text": "пишите на a.b@example.com", "items": [{"note": "+7 912 345-67-89"}], "len": 3}
+    assert aura.pii_redactor.redact(payload) == {
+        "text": "пишите на [email]", "items": [{"note": "[phone]"}], "len": 3,
+    }
@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import asyncio
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+MIGRATION = Path(__file__).resolve().parent.parent / "migrations" / "referral_counters.py"
+
+
+@pytest.fixture
+def referrals(aura, monkeypatch):
+    async def no_log(*args, **kwargs):
+        return None
+
+    async def no_send(*args, **kwargs):
+        return None
+
+    monkeypatch.setattr(aura, "log_event", no_log)
+    monkeypatch.setattr(aura.bot, "send_message", no_send)
+    return aura
+
+
+def _recount() -> None:
+    spec = importlib.util.spec_from_file_location("referral_counters_migration", MIGRATION)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    assert asyncio.run(module.run()) == 0
+
+
+def _snapshot(aura, user_tg_id: int):
+    counters = asyncio.run(aura.get_referral_counters(user_tg_id))
+    return counters.clicked, counters.joined, counters.paid, counters.bonus_days
+
+
+def test_incremental_counters_match_recount(referrals):
+    aura = referrals
+    referrer = 5_000_001
+
+    async def scenario():
+        await aura.record_referral(referrer, 11, "c", "clicked")
+        await aura.record_referral(referrer, 12, "c", "joined")
+        await aura.record_referral(referrer, 11, "c", "joined")  # clicked → joined
+        await aura.record_referral(referrer, 13, "c", "clicked")
+        await aura.record_referral(referrer, 13, "c", "clicked")  # повтор не считается
+        await aura.record_referral(referrer, referrer, "c", "self")
+        await aura.grant_bonus(referrer, "promo", 5)
+        await aura.grant_bonus(referrer, "promo", 4, activated=False)
+        assert await aura.activate_referral_reward_for_payer(12)
+
+    asyncio.run(scenario())
+    incremental = _snapshot(aura, referrer)
+    assert incremental == (1, 1, 1, 5 + aura.REF_BONUS_DAYS_PAID)
+    _recount()
+    assert _snapshot(aura, referrer) == incremental
+
+
+def test_recount_backfills_rows_written_before_counters(referrals):
+    aura = referrals
+    referrer = 5_000_002
+
+    async def legacy_rows():
+        async with aura.session_scope() as s:
+            s.add(aura.Referral(code="c", referrer_tg_id=referrer, referred_tg_id=21, status="paid"))
+            s.add(aura.Referral(code="c", referrer_tg_id=referrer, referred_tg_id=22, status="clicked"))
+            s.add(aura.UserBonus(user_tg_id=referrer, type="ref_paid", days=7, activated=True))
+
+    asyncio.run(legacy_rows())
+    assert _snapshot(aura, referrer) == (0, 0, 0, 0)
+    _recount()
+    assert _snapshot(aura, referrer) == (1, 0, 1, 7)
+    asyncio.run(aura.record_referral(referrer, 23, "c", "joined"))
+    assert _snapshot(aura, referrer) == (1, 1, 1, 7)
+
+
+def test_concurrent_writes_for_one_referrer(referrals):
+    aura = referrals
+    referrer = 5_000_003
+
+    async def scenario():
+        await asyncio.gather(*(aura.record_referral(referrer, 100 + i, "c", "joined") for i in range(10)))
+
+    asyncio.run(scenario())
+    assert _snapshot(aura, referrer) == (0, 10, 0, 0)
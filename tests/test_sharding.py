@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import asyncio
+import queue
+from typing import Any, Dict, List, Tuple
+
+from aiogram import Bot, Dispatcher, F, Router
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Message, Update
+
+
+def _raw(update_id: int, user_id: int) -> Dict[str, Any]:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 1700000000,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "user"},
+            "text": "hi",
+        },
+    }
+
+
+def _shard_queue(*batches: List[Dict[str, Any]]) -> "queue.Queue":
+    q: "queue.Queue" = queue.Queue()
+    for batch in batches:
+        q.put(batch)
+    q.put(None)
+    return q
+
+
+def test_shard_worker_keeps_per_user_order(aura):
+    finished: List[Tuple[int, int]] = []
+    router = Router()
+
+    @router.message(F.text)
+    async def handler(message: Message) -> None:
+        # ранние апдейты дольше уступают event loop — без полос пользователя они завершились бы последними
+        for _ in range(6 - message.message_id % 6):
+            await asyncio.sleep(0)
+        finished.append((message.from_user.id, message.message_id))
+
+    dp = Dispatcher(storage=MemoryStorage(), events_isolation=aura.UserLaneIsolation(max_in_flight=8))
+    dp.include_router(router)
+    bot = Bot("123456:tests")
+    updates = _shard_queue([_raw(i, 1 + i % 2) for i in range(6)], [_raw(i, 1 + i % 2) for i in range(6, 12)])
+
+    asyncio.run(aura._drain_shard_queue(updates, lambda update: dp.feed_update(bot, update), max_pending=8))
+
+    for user_id in (1, 2):
+        assert [seq for uid, seq in finished if uid == user_id] == list(range(user_id - 1, 12, 2))
+
+
+def test_shard_worker_stops_reading_when_saturated(aura):
+    started: List[int] = []
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def handle(update: Update) -> None:
+            started.append(update.update_id)
+            await release.wait()
+            if update.update_id == 1:
+                raise RuntimeError("handler failed")
+
+        updates = _shard_queue([_raw(1, 1), _raw(2, 2), _raw(3, 3)], [_raw(4, 4)])
+        worker = asyncio.create_task(aura._drain_shard_queue(updates, handle, max_pending=2))
+        for _ in range(50):
+            await asyncio.sleep(0.01)
+        assert started == [1, 2]
+        assert updates.qsize() == 2  # вторая пачка и None ещё в очереди
+        release.set()
+        await worker
+
+    asyncio.run(scenario())
+    assert started == [1, 2, 3, 4]
+
+
+def test_get_updates_retry_delay(aura):
+    assert aura.get_updates_retry_delay({"ok": False, "error_code": 401}, 1.0) is None
+    assert aura.get_updates_retry_delay(
+        {"ok": False, "error_code": 429, "parameters": {"retry_after": 17}}, 1.0) == 17.0
+    assert aura.get_updates_retry_delay({"ok": False, "error_code": 409}, 8.0) == 8.0
+    assert aura.get_updates_retry_delay({"ok": False, "error_code": None}, 2.0) == 2.0
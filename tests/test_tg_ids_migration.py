@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import asyncio
+import importlib.util
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+from sqlalchemy.ext.asyncio import create_async_engine
+
+MIGRATION = Path(__file__).resolve().parent.parent / "migrations" / "tg_ids_to_bigint.py"
+
+LEGACY_SCHEMA = [
+    "CREATE TABLE users (id INTEGER PRIMARY KEY, tg_id VARCHAR(64) NOT NULL)",
+    "CREATE UNIQUE INDEX ix_users_tg_id ON users (tg_id)",
+    "CREATE TABLE user_bonuses (id INTEGER PRIMARY KEY, user_tg_id VARCHAR(64) NOT NULL)",
+    "CREATE INDEX ix_user_bonuses_user_tg_id ON user_bonuses (user_tg_id)",
+]
+
+pytestmark = pytest.mark.skipif(sqlite3.sqlite_version_info < (3, 35, 0), reason="нужен DROP COLUMN")
+
+
+@pytest.fixture
+def legacy_db(tmp_path, monkeypatch):
+    path = tmp_path / "legacy.db"
+    with sqlite3.connect(path) as conn:
+        for statement in LEGACY_SCHEMA:
+            conn.execute(statement)
+        conn.executemany("INSERT INTO users (id, tg_id) VALUES (?, ?)", [(1, "101"), (2, "102")])
+        conn.executemany("INSERT INTO user_bonuses (id, user_tg_id) VALUES (?, ?)",
+                         [(1, "101"), (2, "@nick"), (3, "102")])
+    spec = importlib.util.spec_from_file_location("tg_ids_migration", MIGRATION)
+    module = importlib.util.module_from_spec(spec)
+    monkeypatch.setitem(sys.modules, spec.name, module)  # dataclass ищет свой модуль в sys.modules
+    spec.loader.exec_module(module)
+    monkeypatch.setattr(module, "engine", create_async_engine(f"sqlite+aiosqlite:///{path}"))
+    return module, path
+
+
+def _column_types(path: Path, table: str) -> dict:
+    with sqlite3.connect(path) as conn:
+        return {row[1]: row[2] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def test_swap_refuses_before_touching_any_table(legacy_db, capsys):
+    migration, path = legacy_db
+
+    assert asyncio.run(migration.run("all", batch=1, pause=0)) == 1
+
+    assert "id=2: '@nick'" in capsys.readouterr().out
+    # users стоит в списке раньше, но и его swap не тронул
+    assert _column_types(path, "users")["tg_id"] == "VARCHAR(64)"
+    assert _column_types(path, "user_bonuses")["user_tg_id"] == "VARCHAR(64)"
+
+
+def test_swap_runs_after_bad_rows_are_fixed(legacy_db):
+    migration, path = legacy_db
+    asyncio.run(migration.run("backfill", batch=1, pause=0))
+    with sqlite3.connect(path) as conn:
+        conn.execute("DELETE FROM user_bonuses WHERE id = 2")
+
+    assert asyncio.run(migration.run("swap", batch=1, pause=0)) == 0
+
+    assert _column_types(path, "users")["tg_id"] == "BIGINT"
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("SELECT user_tg_id FROM user_bonuses ORDER BY id").fetchall() == [(101,), (102,)]
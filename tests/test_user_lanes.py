@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import asyncio
+from typing import List, Optional
+
+from aiogram import Bot, Dispatcher, F, Router
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Message, Update
+
+
+def _update(update_id: int, user_id: int, text: str) -> Update:
+    return Update.model_validate({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 1700000000,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "user"},
+            "text": text,
+        },
+    })
+
+
+def _dispatcher(aura, seen: List[Optional[str]]) -> Dispatcher:
+    router = Router()
+
+    @router.message(F.text)
+    async def handler(message: Message, state: FSMContext, raw_state: Optional[str]) -> None:
+        seen.append(raw_state)
+        await asyncio.sleep(0.01)  # «медленный» обработчик: следующий апдейт успевает прийти
+        await state.set_state(aura.JournalFlow.waiting_note)
+
+    dp = Dispatcher(storage=MemoryStorage(), events_isolation=aura.UserLaneIsolation(max_in_flight=8))
+    dp.include_router(router)
+    return dp
+
+
+def test_same_user_updates_see_fresh_fsm_state(aura):
+    seen: List[Optional[str]] = []
+    dp = _dispatcher(aura, seen)
+    bot = Bot("123456:tests")
+
+    async def scenario():
+        await asyncio.gather(*(dp.feed_update(bot, _update(i, 42, "note")) for i in (1, 2)))
+
+    asyncio.run(scenario())
+    assert seen == [None, aura.JournalFlow.waiting_note.state]
+
+
+def test_lanes_are_released(aura):
+    lanes = aura.UserLaneIsolation(max_in_flight=2)
+    dp = Dispatcher(storage=MemoryStorage(), events_isolation=lanes)
+    router = Router()
+
+    @router.message(F.text)
+    async def handler(message: Message) -> None:
+        await asyncio.sleep(0.01)
+
+    dp.include_router(router)
+    bot = Bot("123456:tests")
+
+    async def scenario():
+        await asyncio.gather(*(dp.feed_update(bot, _update(i, 100 + i % 3, "hi")) for i in range(9)))
+
+    asyncio.run(scenario())
+    stats = lanes.stats()
+    assert stats["lanes"] == 0 and stats["in_flight"] == 0
+    assert stats["max_lanes"] == 3